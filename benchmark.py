@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+import argparse
+from datetime import datetime
+import functools
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# This script measures the hot paths of LexUse on generated data and appends
+# the results to a JSON file so that throughput and memory can be compared
+# between versions. Every case runs in its own process so that the peak
+# memory reported is that of the case alone.
+#
+# Usage: ./benchmark.py --sizes 10,100,1000
+
+# The modules read the credentials and the loglevel on import
+os.environ.setdefault("LEXUSE_USERNAME", "benchmark")
+os.environ.setdefault("LEXUSE_PASSWORD", "benchmark")
+import config  # noqa: E402
+config.loglevel = logging.WARNING
+import corpus_index  # noqa: E402
+import europarl  # noqa: E402
+
+# Words per sentence in the generated corpus
+min_sentence_length = 3
+max_sentence_length = 40
+vocabulary_size = 50000
+# Ranks in the vocabulary of the words we search for
+search_ranks = dict(frequent=1, medium=200, rare=20000)
+batch_size = 100
+# Numbers of processes the parallel scan is checked with
+scan_process_counts = (2, 3, 4)
+e2e_forms = 50
+# Seconds a case may run before it is stopped and recorded as failed
+case_timeout = 3600
+
+
+@functools.lru_cache(maxsize=None)
+def vocabulary():
+    """Returns made up words and their Zipf distributed cumulative weights.
+    The same words are returned on every run."""
+    generator = random.Random(1)
+    letters = "abcdefghijklmnoprstuvyåäö"
+    words = []
+    seen = set()
+    while len(words) < vocabulary_size:
+        word = "".join(
+            generator.choice(letters)
+            for _ in range(generator.randint(2, 12))
+        )
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    cum_weights = []
+    total = 0
+    for rank in range(1, vocabulary_size + 1):
+        total += 1 / rank
+        cum_weights.append(total)
+    return words, cum_weights
+
+
+def generate_corpus(filename, size_mb):
+    """Writes a corpus of about size_mb megabytes with one sentence per
+    line like the Europarl files"""
+    print(f"Generating a corpus of {size_mb} MB in {filename}")
+    generator = random.Random(size_mb)
+    words, cum_weights = vocabulary()
+    size = size_mb * 1024 * 1024
+    written = 0
+    with open(filename + ".tmp", "w", encoding="utf-8") as outfile:
+        while written < size:
+            tokens = generator.choices(words, cum_weights=cum_weights,
+                                       k=100000)
+            lines = []
+            position = 0
+            while position < len(tokens):
+                length = generator.randint(min_sentence_length,
+                                           max_sentence_length)
+                sentence = tokens[position:position + length]
+                position += length
+                lines.append(
+                    sentence[0].capitalize() + " " +
+                    " ".join(sentence[1:]) + " .\n"
+                )
+            chunk = "".join(lines)
+            outfile.write(chunk)
+            written += len(chunk.encode("utf-8"))
+    os.replace(filename + ".tmp", filename)
+
+
+def corpus_dir(workdir, size_mb):
+    """Returns the directory of the corpus of the size, generating it the
+    first time"""
+    directory = os.path.join(workdir, f"{size_mb}mb")
+    os.makedirs(directory, exist_ok=True)
+    filename = os.path.join(directory, europarl.corpus_filename())
+    if not os.path.isfile(filename):
+        generate_corpus(filename, size_mb)
+    return directory
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(directory, function, args, results):
+    os.chdir(directory)
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    result["seconds"] = round(seconds, 4)
+    result["max_rss_mb"] = round(max_rss_mb(), 1)
+    results.put(result)
+
+
+def isolated(directory, function, *args):
+    """Runs function(*args) in a new process in the directory and returns
+    the dictionary it returns with timing and memory added. A case that
+    dies or runs for longer than case_timeout is returned as failed."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=run_case, args=(directory, function, args, results)
+    )
+    process.start()
+    deadline = time.monotonic() + case_timeout
+    result = None
+    while result is None and time.monotonic() < deadline:
+        alive = process.is_alive()
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not alive:
+                break
+    if result is None:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        print(f"Error. {function.__name__} failed with exit code " +
+              f"{process.exitcode}")
+        return dict(failed=True, exitcode=process.exitcode, seconds=None,
+                    max_rss_mb=None)
+    process.join()
+    return result
+
+
+#
+# Cases, these run in the child process
+#
+
+
+def case_scan(word):
+    numbers = europarl.scan_lines(word)
+    # The sum tells us if another scan found the same lines
+    return dict(hits=len(numbers), checksum=sum(numbers))
+
+
+def case_scan_parallel(word, processes):
+    config.scan_processes = processes
+    numbers = europarl.scan_lines_parallel([word])[word]
+    return dict(hits=len(numbers), checksum=sum(numbers))
+
+
+def case_build_index():
+    corpus_index.build_index(europarl.corpus_filename())
+    return {}
+
+
+def case_lookup(word):
+    europarl.load_index()
+    # Read and verify the candidates like europarl.find_lines() does
+    return dict(hits=sum(
+        1 for number in europarl.lookup_lines(word)
+        if f" {word} " in europarl.get_line(number)
+    ))
+
+
+def case_batch(words):
+    results = europarl.scan_lines_batch(words)
+    return dict(hits=sum(len(results[word]) for word in results))
+
+
+def case_summaries(pages, word):
+    import riksdagen
+    data = dict(
+        word=word,
+        word_spaces=f" {word} ",
+        word_angle_parens=f">{word}<",
+    )
+    records = []
+    for page in pages:
+        records.extend(riksdagen.records_from_page(page))
+    start = time.perf_counter()
+    summaries = riksdagen.extract_summaries_from_records(records, data)
+    extract_seconds = time.perf_counter() - start
+    count = 0
+    for summary in summaries:
+        count += len(riksdagen.find_usage_examples_from_summary(
+            word_spaces=data["word_spaces"], summary=summary
+        ))
+    return dict(
+        records=len(records),
+        summaries=len(summaries),
+        sentences=count,
+        extract_seconds=round(extract_seconds, 4),
+    )
+
+
+def case_e2e(port):
+    import builtins
+    config.wdqs_endpoint = f"http://127.0.0.1:{port}/sparql"
+    config.riksdagen_api_url = f"http://127.0.0.1:{port}/dokumentlista/"
+    config.mediawiki_api_url = f"http://127.0.0.1:{port}/w/api.php"
+    config.http_cache = False
+    config.edit_min_interval = 0
+    # Failed edits are retried, don't measure the waiting
+    config.edit_retry_delay = 0.1
+    config.edit_retry_max_delay = 1
+    config.sparql_results_size = e2e_forms
+    for filename in (config.work_queue_file,
+                     config.work_queue_file + ".position",
+                     config.exclude_log, config.edit_queue_file):
+        if os.path.isfile(filename):
+            os.remove(filename)
+    import edit_queue
+    import util
+    answers = dict(prompts=0)
+
+    def answer(prompt):
+        # Accept every sentence and the first sense
+        answers["prompts"] += 1
+        if "Please input a number" in prompt:
+            return "1"
+        return "y"
+    builtins.input = answer
+    util.process_lexeme_data()
+    return dict(forms=e2e_forms, prompts=answers["prompts"],
+                edits_done=edit_queue.count("done"),
+                edits_failed=edit_queue.count("failed"))
+
+
+def case_work_queue_restart():
+    """Hands out the last lexeme of a page, starts the next page like the
+    prefetch pipeline does and restarts before the lexeme is done. Returns
+    whether the lexeme is offered again first after the restart."""
+    import work_queue
+    prefix = "http://www.wikidata.org/entity/"
+    forms = [{
+        "l": {"value": f"{prefix}L{number}"},
+        "form": {"value": f"{prefix}L{number}-F1"},
+        "word": {"value": f"ord{number}"},
+    } for number in range(1, 7)]
+
+    def fetch_page(after):
+        return [form for form in forms
+                if after is None or work_queue.page_key(form) > after][:3]
+    for filename in (config.work_queue_file,
+                     config.work_queue_file + ".position"):
+        if os.path.isfile(filename):
+            os.remove(filename)
+    queue = work_queue.FormQueue(fetch_page)
+    first_page = [next(queue) for _ in range(3)]
+    for lexeme in first_page[:2]:
+        queue.done(lexeme)
+    # The last lexeme of the first page is being reviewed while the next
+    # page is started and one of its lexemes is done
+    queue.done(next(queue))
+    interrupted = work_queue.lexeme_key(first_page[2][0])
+    resumed = work_queue.FormQueue(fetch_page)
+    offered = work_queue.lexeme_key(next(resumed)[0])
+    remaining = 1 + sum(1 for _ in resumed)
+    return dict(offered_again=offered == interrupted, remaining=remaining)
+
+
+#
+# Stub server for WDQS, Riksdagen and the MediaWiki API
+#
+
+
+def synthetic_page(word, page, hits):
+    """Returns a dokumentlista page like the Riksdagen API does"""
+    generator = random.Random(f"{word}{page}")
+    words, cum_weights = vocabulary()
+    documents = []
+    for number in range(20):
+        sentences = []
+        for _ in range(generator.randint(2, 6)):
+            tokens = generator.choices(
+                words, cum_weights=cum_weights,
+                k=generator.randint(min_sentence_length, 25)
+            )
+            if generator.random() < 0.5:
+                tokens.insert(generator.randint(1, len(tokens)),
+                              '<span class="traff-markering">' + word +
+                              '</span>')
+            if generator.random() < 0.1:
+                tokens.append("Riksdagen t.ex. m.m")
+            sentences.append(
+                tokens[0].capitalize() + " " + " ".join(tokens[1:]) + "."
+            )
+        documents.append(dict(
+            id=f"H{page}{number:02}",
+            datum="2020-01-01",
+            summary=" ".join(sentences),
+        ))
+    return {"dokumentlista": {"@traffar": str(hits), "dokument": documents}}
+
+
+def load_pages(directory):
+    """Returns the recorded dokumentlista JSON files in the directory"""
+    pages = []
+    for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(filename, encoding="utf-8") as infile:
+            pages.append(json.load(infile))
+    return pages
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    words = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parameters(self):
+        parameters = parse_qs(urlsplit(self.path).query)
+        if self.command == "POST":
+            length = int(self.headers.get("Content-Length", 0))
+            parameters.update(
+                parse_qs(self.rfile.read(length).decode("utf-8"))
+            )
+        return {key: parameters[key][0] for key in parameters}
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        parameters = self.parameters()
+        if path == "/sparql":
+            self.send_json(self.wdqs(parameters["query"]))
+        elif path == "/dokumentlista/":
+            self.send_json(synthetic_page(
+                parameters["sok"], int(parameters["p"]), 200
+            ))
+        elif path == "/w/api.php":
+            self.send_json(self.mediawiki(parameters))
+        else:
+            self.send_error(404)
+
+    do_POST = do_GET
+
+    def wdqs(self, query):
+        prefix = "http://www.wikidata.org/entity/"
+        bindings = []
+        if "?catLabel" in query:
+            for number, word in enumerate(self.words):
+                number += 1
+                bindings.append({
+                    "l": {"value": f"{prefix}L{number}"},
+                    "form": {"value": f"{prefix}L{number}-F1"},
+                    "word": {"value": word},
+                    "catLabel": {"value": "noun"},
+                })
+            # Pages are ordered by the form, which has a single word here
+            bindings.sort(key=lambda binding: binding["form"]["value"])
+            after = re.search(r'FILTER\(STR\(\?form\) > ("(?:[^"\\]|\\.)*")',
+                              query)
+            if after is not None:
+                after = json.loads(after.group(1))
+                bindings = [binding for binding in bindings
+                            if binding["form"]["value"] > after]
+            limit = re.search(r"limit (\d+)", query)
+            if limit is not None:
+                bindings = bindings[:int(limit.group(1))]
+        elif "COUNT" in query:
+            bindings.append({"count": {"value": "1"}})
+        elif "VALUES ?l {" in query:
+            values = query.split("VALUES ?l {")[1].split("}")[0]
+            for lid in values.replace("wd:", "").split():
+                bindings.append({
+                    "l": {"value": prefix + lid},
+                    "sense": {"value": f"{prefix}{lid}-S1"},
+                    "gloss": {"value": "en förklaring"},
+                })
+        # Other queries, e.g. the ones of WBI itself, get no results
+        return {"results": {"bindings": bindings}}
+
+    def mediawiki(self, parameters):
+        action = parameters.get("action")
+        if action == "query":
+            return {"query": {"tokens": {
+                "logintoken": "+\\", "csrftoken": "+\\", "watchtoken": "+\\",
+            }}}
+        if action == "login":
+            # WBI asks for a login token with a first login request
+            if "lgtoken" not in parameters:
+                return {"login": {"result": "NeedToken", "token": "stub"}}
+            return {"login": {"result": "Success",
+                              "lgusername": config.username}}
+        if action == "wbgetentities":
+            lid = parameters["ids"]
+            return {"entities": {lid: dict(
+                type="lexeme", id=lid, lastrevid=1, claims={},
+                lemmas={}, forms=[], senses=[],
+            )}, "success": 1}
+        if action == "wbeditentity":
+            # WBI parses the entity that was saved
+            return {"success": 1, "entity": dict(
+                type="lexeme", id=parameters.get("id"), lastrevid=2,
+                claims={},
+            )}
+        if action == "watch":
+            return {"watch": [{"title": parameters.get("titles"),
+                               "watched": True}]}
+        return {}
+
+
+def start_stub_server(words):
+    StubHandler.words = words
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+#
+# Suite
+#
+
+
+def corpus_benchmarks(workdir, size_mb):
+    directory = corpus_dir(workdir, size_mb)
+    filename = os.path.join(directory, europarl.corpus_filename())
+    corpus_mb = os.path.getsize(filename) / 1024 / 1024
+    words = vocabulary()[0]
+    results = []
+
+    def add(name, variant, result, **extra):
+        result.update(benchmark=name, variant=variant,
+                      corpus_mb=round(corpus_mb, 1), **extra)
+        if (("hits" in result or variant == "build")
+                and not result.get("failed")):
+            result["mb_per_second"] = round(corpus_mb / result["seconds"], 1)
+        print(f"{name} {variant} {size_mb} MB {extra}: " +
+              f"{result['seconds']} s, {result['max_rss_mb']} MB RSS")
+        results.append(result)
+
+    serial = {}
+    for label in search_ranks:
+        word = words[search_ranks[label] - 1]
+        serial[label] = isolated(directory, case_scan, word)
+        add("europarl.find_lines", "scan", serial[label], word=label)
+    # The parallel scan is only used without an index so it runs before the
+    # index is built. It has to find the same lines as the serial one.
+    for processes in scan_process_counts:
+        for label in search_ranks:
+            word = words[search_ranks[label] - 1]
+            result = isolated(directory, case_scan_parallel, word, processes)
+            result["matches_serial"] = (
+                not result.get("failed")
+                and not serial[label].get("failed")
+                and (result["hits"], result["checksum"]) ==
+                (serial[label]["hits"], serial[label]["checksum"])
+            )
+            if not (result["matches_serial"] or result.get("failed")):
+                print(f"Error. The parallel scan with {processes} processes " +
+                      f"found {result['hits']} lines for the {label} word, " +
+                      f"the serial scan {serial[label]['hits']}")
+            add("europarl.scan_lines_parallel", "scan", result, word=label,
+                processes=processes)
+    add("corpus_index.build_index", "build",
+        isolated(directory, case_build_index))
+    for label in search_ranks:
+        word = words[search_ranks[label] - 1]
+        add("europarl.find_lines", "index",
+            isolated(directory, case_lookup, word), word=label)
+    add("europarl.find_lines_batch", "scan",
+        isolated(directory, case_batch, words[:batch_size]),
+        words=batch_size)
+    return results
+
+
+def riksdagen_benchmarks(workdir, dokumentlista):
+    words, _ = vocabulary()
+    word = words[search_ranks["medium"] - 1]
+    if dokumentlista is not None:
+        pages = load_pages(dokumentlista)
+        variant = "recorded"
+    else:
+        pages = [synthetic_page(word, page, 500) for page in range(1, 26)]
+        variant = "synthetic"
+    result = isolated(workdir, case_summaries, pages, word)
+    result.update(benchmark="riksdagen.find_usage_examples_from_summary",
+                  variant=variant, pages=len(pages))
+    print(f"Riksdagen cleaning of {len(pages)} pages: " +
+          f"{result['seconds']} s")
+    return [result]
+
+
+def work_queue_checks(workdir):
+    result = isolated(workdir, case_work_queue_restart)
+    result.update(benchmark="work_queue.FormQueue", variant="restart")
+    if not result.get("offered_again"):
+        print("Error. A lexeme that was not done when the next page was " +
+              "started was not offered again after a restart")
+    return [result]
+
+
+def e2e_benchmarks(workdir):
+    words, _ = vocabulary()
+    directory = corpus_dir(workdir, 10)
+    # Half of the forms are frequent in the corpus and half are rare enough
+    # to need Riksdagen
+    half = e2e_forms // 2
+    server = start_stub_server(
+        words[50:50 + half] + words[30000:30000 + e2e_forms - half]
+    )
+    try:
+        result = isolated(directory, case_e2e, server.server_address[1])
+    finally:
+        server.shutdown()
+    result.update(benchmark="util.process_lexeme_data", variant="stub")
+    if result.get("edits_failed"):
+        print(f"Error. {result['edits_failed']} of the edits failed, see " +
+              "edit_queue.log")
+        result["failed"] = True
+    if not result.get("failed"):
+        result["seconds_per_form"] = round(result["seconds"] / e2e_forms, 4)
+    print(f"End to end for {e2e_forms} forms: {result['seconds']} s")
+    return [result]
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LexUse")
+    parser.add_argument("--sizes", default="10,100,1000",
+                        help="Comma separated corpus sizes in MB")
+    parser.add_argument("--workdir", default="benchmark_data",
+                        help="Where the generated data is kept")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="JSON file the results are appended to")
+    parser.add_argument("--dokumentlista",
+                        help="Directory with recorded dokumentlista JSON " +
+                        "pages, synthetic pages are used otherwise")
+    parser.add_argument("--skip-e2e", action="store_true",
+                        help="Skip the end to end benchmark")
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for size_mb in [int(size) for size in args.sizes.split(",")]:
+        results.extend(corpus_benchmarks(workdir, size_mb))
+    results.extend(riksdagen_benchmarks(workdir, args.dokumentlista))
+    results.extend(work_queue_checks(workdir))
+    if not args.skip_e2e:
+        results.extend(e2e_benchmarks(workdir))
+    run = dict(
+        version=version(),
+        date=datetime.now().isoformat(),
+        python=sys.version.split()[0],
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+        results=results,
+    )
+    runs = []
+    if os.path.isfile(args.output):
+        with open(args.output, encoding="utf-8") as infile:
+            runs = json.load(infile)
+    runs.append(run)
+    with open(args.output, "w", encoding="utf-8") as outfile:
+        json.dump(runs, outfile, ensure_ascii=False, indent=2)
+    print(f"Results appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import heapq
+
+import metrics
+
+# Streaming selection of the best usage example candidates. Frequent words
+# like "och" match a large part of a corpus but the user only looks at the
+# first few sentences, so we keep the k best in a bounded heap instead of
+# collecting and sorting every hit.
+
+
+def select(candidates, k, score, accept=None, good_enough=None):
+    """Returns up to k candidates with the lowest score, lowest first.
+
+    score is called for every candidate and should be cheap. accept is only
+    called for the candidates that would enter the selection, so it can be
+    an expensive check like reading the text of a line. The iteration stops
+    early when k accepted candidates score at most good_enough."""
+    # A max heap of (-score, -order, candidate) holding the best so far. The
+    # order keeps equal scores in input order and candidates uncompared.
+    heap = []
+    if k <= 0:
+        return heap
+    seen = 0
+    for order, candidate in enumerate(candidates):
+        seen += 1
+        candidate_score = score(candidate)
+        if len(heap) == k and candidate_score >= -heap[0][0]:
+            continue
+        if accept is not None and not accept(candidate):
+            continue
+        entry = (-candidate_score, -order, candidate)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heapreplace(heap, entry)
+        if (good_enough is not None and len(heap) == k
+                and -heap[0][0] <= good_enough):
+            metrics.increment("candidates_stopped_early")
+            break
+    metrics.increment("candidates_scored", seen)
+    return [entry[2] for entry in sorted(heap, reverse=True)]
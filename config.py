@@ -7,15 +7,104 @@ password = os.environ['LEXUSE_PASSWORD']
 
 # Settings
 sparql_results_size = 1000
-sparql_offset = 1000
+# Where the forms to work on come from: "wdqs" queries the Wikidata Query
+# Service and "dump" reads a local Wikidata lexemes dump, see lexeme_dump.py
+lexeme_source = "wdqs"
+lexeme_dump_file = "latest-lexemes.json.gz"
+lexeme_db_file = "lexemes.sqlite"
 riksdagen_max_results_size = 500  # keep to multiples of 20
+riksdagen_max_concurrent_requests = 5
+# Stop downloading more pages when this many suitable sentences were found
+riksdagen_enough_sentences = 10
+# "api" searches the Riksdagen API and "local" the full text mirror built
+# by riksdagen_mirror.py from the bulk open data archives
+riksdagen_backend = "api"
+riksdagen_mirror_file = "riksdagen.sqlite"
 language = "swedish"
 language_code = "sv"
 language_qid = "Q9027"
 min_word_count = 5
 max_word_count = 15
+# At most this many sentences are kept per form, the shortest first
+max_candidates = 50
+# Sentences up to this many characters are short enough. The corpus search
+# for a form stops once it holds max_candidates of them.
+short_sentence_length = 60
+# Seconds to wait for each source of usage examples before presenting what
+# we have. Sentences found later are merged in while presenting.
+source_deadlines = dict(europarl=10, riksdagen=20)
+default_source_deadline = 10
+# Threads for the sources that are not async
+source_workers = 4
+# Corpus lines that don't start with a capital letter or end with a full
+# stop, exclamation or question mark are ranked as if they were this many
+# characters longer
+sentence_shape_penalty = 1000
+# Processes used to scan the corpus when it has no index
+scan_processes = os.cpu_count() or 1
+# Postings held in memory while building the corpus index before they are
+# written to a temporary file, 4 bytes each plus the tokens
+index_buffer_postings = 8000000
+# Rate of false positives of the Bloom filter of the corpus tokens, which
+# rules out forms that are not in the corpus when there is no index
+bloom_false_positive_rate = 0.01
+# Lexemes whose forms are in fewer lines of the corpus than this are worked
+# on after the others in every page. None keeps the random order.
+few_corpus_hits = 5
+# Skip the forms that are certainly not in the corpus before looking them
+# up. Note that Riksdagen is not searched for them either.
+skip_forms_without_corpus_hits = False
 show_sense_urls = True
+# Number of lexemes per batched sense query
+sense_batch_size = 200
+# Refetch cached senses older than this in the background
+sense_cache_max_age = 3600  # seconds
+# Legacy exclude list, read once and then superseded by exclude_log
 exclude_list = "exclude_list.json"
+exclude_log = "exclude_list.jsonl"
+# Forms are presented again after this many days, None means never
+exclude_list_ttl_days = None
+# Approved usage examples waiting for upload, see edit_queue.py
+edit_queue_file = "edit_queue.sqlite"
+maxlag = 5  # seconds
+# Retries of WBI itself when the servers are lagging
+edit_max_retries_maxlag = 100
+# Retries of the edit queue for other errors, with exponential backoff
+edit_max_attempts = 5
+edit_retry_delay = 30  # seconds
+edit_retry_max_delay = 600  # seconds
+edit_min_interval = 1  # seconds between two edits
+# The shuffled page of forms we are working on, see work_queue.py
+work_queue_file = "work_queue.json"
+# Sentences for this many upcoming forms are gathered in the background
+prefetch_depth = 3
+prefetch_workers = 2
+# Cache of API responses (see http_cache.py)
+http_cache = True
+http_cache_file = "http_cache.sqlite"
+http_cache_ttl = 7 * 24 * 3600  # seconds
+http_cache_max_size_mb = 200
+# Never go online for cached APIs, missing responses count as no results
+http_cache_only = False
+# Shared HTTP connection pools, see http_client.py
+http_max_connections = 20
+http_max_keepalive_connections = 10
+http_keepalive_expiry = 30  # seconds
+http_timeout = 60  # seconds, WDQS queries can be slow
+http_connect_timeout = 10  # seconds
+# HTTP/2 needs the h2 package (pip install httpx[http2])
+http2 = False
+
+# Timing and counters written at exit, see metrics.py
+metrics_file = "metrics.json"
+# Set to a path in the node exporter textfile directory to export to
+# Prometheus
+metrics_prometheus_file = None
+
+# API endpoints
+wdqs_endpoint = "https://query.wikidata.org/sparql"
+riksdagen_api_url = "http://data.riksdagen.se/dokumentlista/"
+mediawiki_api_url = "https://www.wikidata.org/w/api.php"
 
 # Debug settings
 debug = False
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+import array
+import bisect
+import hashlib
+import heapq
+import itertools
+import logging
+import math
+import mmap
+import os
+import shutil
+
+import config
+import loglevel
+
+try:
+    import numpy
+except ImportError:
+    # The line filters fall back to plain Python
+    numpy = None
+
+# This module builds and reads an on-disk inverted index for the line based
+# corpora (e.g. Europarl). The index maps every token to the line numbers of
+# the lines containing it so that a lookup costs time proportional to the
+# number of hits instead of the size of the corpus. A table with the byte
+# offset of every line turns a line number into its text and length without
+# reading anything else, and a table of features of every line lets us
+# filter and rank the hits without reading their text. The line counts in
+# the lexicon double as a token frequency table and a Bloom filter of the
+# tokens tells us that a word is not in the corpus when there is no index.
+#
+# Files written next to the corpus file data_xx.txt:
+# data_xx.lexicon: uint64 version, number of lines and number of tokens,
+# the uint64 byte offsets of the tokens in the token data, the uint64 start
+# of every token in the postings array, each followed by the end, and the
+# tokens sorted bytewise one after the other
+# data_xx.postings: array of uint32 line numbers
+# data_xx.offsets: array of uint64 byte offsets of every line followed by
+# the size of the corpus
+# data_xx.features: the columns uint32 characters, uint16 words and uint8
+# flags of every line one after the other
+# data_xx.bloom: uint64 number of bits and hashes followed by the bits of
+# the Bloom filter
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("corpus_index.log")
+logger.addHandler(file_handler)
+
+# Bump this when the on-disk format changes to force a rebuild
+index_version = 4
+
+
+def index_filenames(txt_filename):
+    """Returns a dictionary with the paths of the index files"""
+    base = os.path.splitext(txt_filename)[0]
+    return dict(
+        lexicon=base + ".lexicon",
+        postings=base + ".postings",
+        offsets=base + ".offsets",
+        features=base + ".features",
+        bloom=base + ".bloom",
+    )
+
+
+def tokenize(line: bytes):
+    """Returns the set of tokens in a line. We split on whitespace which is
+    what the ' word ' substring search in europarl.find_lines() needs"""
+    return set(line.split())
+
+
+# Bits of the flags column
+starts_capitalized = 1
+ends_with_punctuation = 2
+# Bytes per line in the features file
+feature_size = 4 + 2 + 1
+
+
+def line_features(line: bytes):
+    """Returns the number of characters, number of words and flags of the
+    line. Words are counted like util.count_words()."""
+    text = line.decode("utf-8", errors="replace").strip()
+    flags = 0
+    if text[:1].isupper():
+        flags |= starts_capitalized
+    if text[-1:] in (".", "!", "?"):
+        flags |= ends_with_punctuation
+    return len(text), min(len(text.split(" ")), 65535), flags
+
+
+class BloomFilter:
+    """Set of tokens that never misses a token that was added but might
+    claim to hold one that was not"""
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            data = bytearray((bits + 7) // 8)
+        self.data = data
+
+    def positions(self, token: bytes):
+        # Python's hash() differs between runs so we use a stable one
+        digest = hashlib.blake2b(token, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * step) % self.bits for i in range(self.hashes))
+
+    def add(self, token: bytes):
+        for position in self.positions(token):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, token: bytes):
+        return all(self.data[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(token))
+
+
+def write_bloom_filter(txt_filename, tokens):
+    """Writes a Bloom filter of the tokens sized for
+    config.bloom_false_positive_rate"""
+    count = max(len(tokens), 1)
+    bits = max(64, math.ceil(
+        -count * math.log(config.bloom_false_positive_rate) / math.log(2) ** 2
+    ))
+    bloom_filter = BloomFilter(bits, max(1, round(bits / count * math.log(2))))
+    for token in tokens:
+        bloom_filter.add(token)
+    filename = index_filenames(txt_filename)["bloom"]
+    with open(filename + ".tmp", "wb") as bloom_file:
+        array.array("Q", [bloom_filter.bits, bloom_filter.hashes]).tofile(
+            bloom_file
+        )
+        bloom_file.write(bloom_filter.data)
+    os.replace(filename + ".tmp", filename)
+    logger.info(f"Wrote Bloom filter with {bits} bits for {count} tokens")
+
+
+def load_bloom_filter(txt_filename):
+    """Returns the BloomFilter of the corpus or None if there is none"""
+    filename = index_filenames(txt_filename)["bloom"]
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, "rb") as bloom_file:
+        header = array.array("Q")
+        header.frombytes(bloom_file.read(16))
+        data = bytearray(bloom_file.read())
+    return BloomFilter(header[0], header[1], data)
+
+
+class LineTableBuilder:
+    """Collects the offset and features of every line. Feed it with
+    add_line() in corpus order and call write() when done. The columns are
+    written to temporary files every block_lines lines so that the memory
+    used does not grow with the corpus."""
+    block_lines = 65536
+
+    def __init__(self, txt_filename):
+        self.filenames = index_filenames(txt_filename)
+        self.columns = dict(
+            offsets=array.array("Q"),
+            characters=array.array("I"),
+            words=array.array("H"),
+            flags=array.array("B"),
+        )
+        self.files = {
+            name: open(self.part_filename(name), "wb")
+            for name in self.columns
+        }
+        self.position = 0
+
+    def part_filename(self, name):
+        return self.filenames["features"] + f".{name}.tmp"
+
+    def add_line(self, line: bytes):
+        self.columns["offsets"].append(self.position)
+        characters, words, flags = line_features(line)
+        self.columns["characters"].append(characters)
+        self.columns["words"].append(words)
+        self.columns["flags"].append(flags)
+        self.position += len(line)
+        if len(self.columns["offsets"]) >= self.block_lines:
+            self.flush()
+
+    def flush(self):
+        for name in self.columns:
+            self.columns[name].tofile(self.files[name])
+            del self.columns[name][:]
+
+    def abort(self):
+        """Closes and removes the temporary files of an unfinished build"""
+        for name in self.files:
+            self.files[name].close()
+            os.remove(self.part_filename(name))
+
+    def write(self):
+        self.columns["offsets"].append(self.position)
+        self.flush()
+        for name in self.files:
+            self.files[name].close()
+        # The features file holds the columns one after the other
+        with open(self.filenames["features"] + ".tmp", "wb") as features_file:
+            for name in ("characters", "words", "flags"):
+                with open(self.part_filename(name), "rb") as part_file:
+                    shutil.copyfileobj(part_file, features_file)
+                os.remove(self.part_filename(name))
+        os.replace(self.filenames["features"] + ".tmp",
+                   self.filenames["features"])
+        # The offsets are written last and mark the tables as complete
+        os.replace(self.part_filename("offsets"), self.filenames["offsets"])
+
+
+def iter_run(filename):
+    """Yields the (token, line numbers) of a run file in token order"""
+    with open(filename, "rb") as run_file:
+        while True:
+            header = run_file.readline()
+            if not header:
+                return
+            # Tokens never contain whitespace
+            token, count = header.split()
+            lines = array.array("I")
+            lines.fromfile(run_file, int(count))
+            yield token, lines
+
+
+class IndexBuilder:
+    """Collects postings line by line. Feed it with add_line() in corpus
+    order and call write() when done. Every config.index_buffer_postings
+    postings are written to a temporary run file sorted by token and the
+    runs are merged by write() so that the memory used does not grow with
+    the corpus."""
+    def __init__(self, txt_filename):
+        self.txt_filename = txt_filename
+        self.filenames = index_filenames(txt_filename)
+        self.postings = {}
+        self.buffered = 0
+        self.runs = []
+        self.lines = LineTableBuilder(txt_filename)
+        self.number = 0
+
+    def add_line(self, line: bytes):
+        # Line numbers start at 1 like in europarl.find_lines()
+        self.number += 1
+        self.lines.add_line(line)
+        tokens = tokenize(line)
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = array.array("I")
+            self.postings[token].append(self.number)
+        self.buffered += len(tokens)
+        if self.buffered >= config.index_buffer_postings:
+            self.write_run()
+        if self.number % 500000 == 0:
+            logger.info(f"Indexed {self.number} lines")
+
+    def write_run(self):
+        filename = self.filenames["postings"] + f".run{len(self.runs)}.tmp"
+        with open(filename, "wb") as run_file:
+            for token in sorted(self.postings):
+                lines = self.postings[token]
+                run_file.write(token + b" " + str(len(lines)).encode() +
+                               b"\n")
+                lines.tofile(run_file)
+        self.runs.append(filename)
+        self.postings = {}
+        self.buffered = 0
+
+    def abort(self):
+        """Closes and removes the temporary files of an unfinished build"""
+        self.lines.abort()
+        for filename in self.runs:
+            os.remove(filename)
+        self.runs = []
+        self.postings = {}
+
+    def write(self):
+        self.write_run()
+        tokens = []
+        token_offsets = array.array("Q", [0])
+        starts = array.array("Q", [0])
+        # The runs hold increasing line numbers so the postings of a token
+        # are concatenated in the order of the runs, which is how merge()
+        # orders equal tokens
+        merged = heapq.merge(
+            *[iter_run(filename) for filename in self.runs],
+            key=lambda run_item: run_item[0],
+        )
+        # Write to temporary files first so that an interrupted build is
+        # never mistaken for a complete index
+        with open(self.filenames["postings"] + ".tmp",
+                  "wb") as postings_file:
+            for token, group in itertools.groupby(
+                    merged, key=lambda run_item: run_item[0]):
+                count = 0
+                for _, lines in group:
+                    lines.tofile(postings_file)
+                    count += len(lines)
+                tokens.append(token)
+                token_offsets.append(token_offsets[-1] + len(token))
+                starts.append(starts[-1] + count)
+        for filename in self.runs:
+            os.remove(filename)
+        os.replace(self.filenames["postings"] + ".tmp",
+                   self.filenames["postings"])
+        self.lines.write()
+        write_bloom_filter(self.txt_filename, tokens)
+        # The lexicon is written last and marks the index as complete
+        with open(self.filenames["lexicon"] + ".tmp", "wb") as lexicon_file:
+            array.array("Q", [index_version, self.number, len(tokens)]).tofile(
+                lexicon_file
+            )
+            token_offsets.tofile(lexicon_file)
+            starts.tofile(lexicon_file)
+            for token in tokens:
+                lexicon_file.write(token)
+        os.replace(self.filenames["lexicon"] + ".tmp",
+                   self.filenames["lexicon"])
+        logger.info(f"Wrote index with {len(tokens)} tokens " +
+                    f"for {self.number} lines from {len(self.runs)} runs")
+
+
+def build_line_tables(txt_filename):
+    """Builds only the line offset and features tables by reading the corpus
+    once. This is used when there is no index to search with. The Bloom
+    filter of the tokens is built in the same pass."""
+    logger.info(f"Building the line tables for {txt_filename}")
+    builder = LineTableBuilder(txt_filename)
+    tokens = set()
+    with open(txt_filename, "rb") as corpus:
+        for line in corpus:
+            builder.add_line(line)
+            tokens.update(tokenize(line))
+    write_bloom_filter(txt_filename, tokens)
+    builder.write()
+
+
+def line_tables_exist(txt_filename):
+    """The tables are stale if the offsets do not end at the size of the
+    corpus"""
+    filenames = index_filenames(txt_filename)
+    if not (os.path.isfile(filenames["offsets"])
+            and os.path.isfile(filenames["features"])):
+        return False
+    with open(filenames["offsets"], "rb") as offsets_file:
+        offsets_file.seek(-8, os.SEEK_END)
+        last = array.array("Q")
+        last.frombytes(offsets_file.read(8))
+        lines = offsets_file.tell() // 8 - 1
+    return (last[0] == os.path.getsize(txt_filename) and
+            os.path.getsize(filenames["features"]) == lines * feature_size)
+
+
+def build_index(txt_filename):
+    """Builds the index by reading the corpus once"""
+    print(f"Building the search index for {txt_filename}. " +
+          "This is only done once.")
+    builder = IndexBuilder(txt_filename)
+    with open(txt_filename, "rb") as corpus:
+        for line in corpus:
+            builder.add_line(line)
+    builder.write()
+    print("Index done")
+
+
+def index_exists(txt_filename):
+    filenames = index_filenames(txt_filename)
+    if not all(os.path.isfile(filenames[key]) for key in filenames):
+        return False
+    with open(filenames["lexicon"], "rb") as lexicon_file:
+        version = array.array("Q")
+        version.frombytes(lexicon_file.read(8))
+    return len(version) == 1 and version[0] == index_version
+
+
+def ensure_index(txt_filename):
+    if not index_exists(txt_filename):
+        build_index(txt_filename)
+
+
+def map_array(filename, typecode):
+    """Returns a memoryview of the file cast to the typecode and the mmap
+    backing it"""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return array.array(typecode), None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode), mapped
+
+
+class Lexicon:
+    """Memory mapped sorted tokens of the index. It is a sequence of the
+    tokens so that bisect can search it without loading it."""
+    def __init__(self, filename):
+        data, self._map = map_array(filename, "B")
+        # The version was checked by index_exists()
+        header = data[:24].cast("Q")
+        self.lines, count = header[1], header[2]
+        end = 24 + 8 * (count + 1)
+        self.token_offsets = data[24:end].cast("Q")
+        self.starts = data[end:end + 8 * (count + 1)].cast("Q")
+        self.data = data[end + 8 * (count + 1):]
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, number: int):
+        return bytes(self.data[
+            self.token_offsets[number]:self.token_offsets[number + 1]
+        ])
+
+    def find(self, token: bytes):
+        """Returns the start and count of the line numbers of the token in
+        the postings array or None if it is not in the index"""
+        number = bisect.bisect_left(self, token)
+        if number < len(self) and self[number] == token:
+            start = self.starts[number]
+            return start, self.starts[number + 1] - start
+        return None
+
+
+class CorpusIndex:
+    """Memory mapped inverted index"""
+    def __init__(self, txt_filename):
+        filenames = index_filenames(txt_filename)
+        self.lexicon = Lexicon(filenames["lexicon"])
+        self.lines = self.lexicon.lines
+        self.postings, self._postings_map = map_array(
+            filenames["postings"], "I"
+        )
+        logger.info(f"Loaded index with {len(self.lexicon)} tokens")
+
+    def count(self, token: str):
+        """Returns the number of lines containing the token"""
+        found = self.lexicon.find(token.encode("utf-8"))
+        if found is None:
+            return 0
+        return found[1]
+
+    def lookup(self, word: str):
+        """Returns the line numbers of the lines that may contain the word.
+        Callers must verify the hits against the line text."""
+        tokens = word.split()
+        if len(tokens) == 0:
+            return array.array("I")
+        # For multi word forms the rarest token gives the fewest candidates
+        token = min(tokens, key=self.count)
+        found = self.lexicon.find(token.encode("utf-8"))
+        if found is None:
+            return array.array("I")
+        start, count = found
+        return self.postings[start:start + count]
+
+
+class LineTable:
+    """Memory mapped corpus with its line offset and features tables. Lines
+    are numbered from 1 like in the index."""
+    def __init__(self, txt_filename):
+        filenames = index_filenames(txt_filename)
+        self.offsets, self._offsets_map = map_array(
+            filenames["offsets"], "Q"
+        )
+        features, self._features_map = map_array(filenames["features"], "B")
+        # The columns are slices of the same file
+        features = memoryview(features)
+        count = len(self)
+        self.characters = features[:4 * count].cast("I")
+        self.words = features[4 * count:6 * count].cast("H")
+        self.flags = features[6 * count:7 * count]
+        with open(txt_filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self.corpus = b""
+            else:
+                self.corpus = mmap.mmap(f.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, number: int):
+        return self.corpus[
+            self.offsets[number - 1]:self.offsets[number]
+        ].decode("utf-8")
+
+    def filter(self, numbers, min_words, max_words):
+        """Returns an array of the line numbers with a word count in the
+        range without reading the lines"""
+        if len(numbers) == 0:
+            return array.array("I")
+        if numpy is None:
+            words = self.words
+            return array.array("I", (
+                number for number in numbers
+                if min_words <= words[number - 1] <= max_words
+            ))
+        numbers = numpy.asarray(numbers, dtype=numpy.uint32)
+        words = numpy.frombuffer(self.words, dtype=numpy.uint16)[
+            numbers - 1
+        ]
+        kept = array.array("I")
+        kept.frombytes(
+            numbers[(words >= min_words) & (words <= max_words)].tobytes()
+        )
+        return kept
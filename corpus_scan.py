@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import mmap
+import os
+
+# Workers for scanning a line based corpus in parallel, see
+# europarl.scan_lines_parallel(). The file is split in byte ranges that start
+# and end at line boundaries and every range is scanned in its own process
+# over a memory map. This module only uses the standard library so that the
+# worker processes start quickly and don't run the atexit handlers of the
+# rest of LexUse.
+
+# Newlines are counted in blocks of this size to keep the memory bounded
+count_block_size = 16 * 1024 * 1024
+
+
+def line_boundaries(filename, parts):
+    """Returns a list of (start, end) byte ranges covering the file where
+    every range starts at the beginning of a line"""
+    size = os.path.getsize(filename)
+    starts = [0]
+    with open(filename, "rb") as f:
+        for part in range(1, parts):
+            f.seek(part * size // parts)
+            # Move on to the beginning of the next line
+            f.readline()
+            position = f.tell()
+            if position > starts[-1] and position < size:
+                starts.append(position)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def count_lines(mapped, start, end):
+    count = 0
+    for block in range(start, end, count_block_size):
+        count += mapped[block:min(block + count_block_size, end)].count(b"\n")
+    return count
+
+
+def line_at(mapped, position, start, end):
+    """Returns the start and end of the line containing the position"""
+    # Without a newline before it the line is the first one of the range
+    line_start = max(start, mapped.rfind(b"\n", start, position) + 1)
+    line_end = mapped.find(b"\n", position, end)
+    if line_end == -1:
+        line_end = end
+    else:
+        # Keep the newline like iterating over a file does
+        line_end += 1
+    return line_start, line_end
+
+
+def scan_chunk(filename, start, end, words):
+    """Returns the number of lines in the range and a dictionary with word as
+    key and a list of the numbers of the lines in the range containing
+    ' word '. Line numbers start at 0."""
+    hits = {word: [] for word in words}
+    if end == start:
+        return 0, hits
+    if len(words) > 1:
+        return scan_words(filename, start, end, words, hits), hits
+    with open(filename, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        scan_word(mapped, start, end, words[0], hits[words[0]])
+        return count_lines(mapped, start, end), hits
+    finally:
+        mapped.close()
+
+
+def scan_word(mapped, start, end, word, hits):
+    """Finds the lines with one word by searching for the pattern directly
+    so that lines without it are skipped in C"""
+    pattern = f" {word} ".encode("utf-8")
+    position = start
+    # Line number of the line starting at counted_to
+    number = 0
+    counted_to = start
+    while True:
+        position = mapped.find(pattern, position, end)
+        if position == -1:
+            break
+        line_start, line_end = line_at(mapped, position, start, end)
+        number += count_lines(mapped, counted_to, line_start)
+        counted_to = line_start
+        hits.append(number)
+        position = line_end
+
+
+def scan_words(filename, start, end, words, hits):
+    """Finds the lines with any of the words in one pass by looking up the
+    tokens of every line. Returns the number of lines in the range."""
+    # Every line matching " word " contains the first token of the word so
+    # we only need to verify the words whose first token is in the line
+    words_by_token = {}
+    for word in words:
+        tokens = word.encode("utf-8").split()
+        if len(tokens) > 0:
+            words_by_token.setdefault(tokens[0], []).append(word)
+    patterns = {word: f" {word} ".encode("utf-8") for word in words}
+    number = 0
+    position = start
+    with open(filename, "rb") as f:
+        f.seek(start)
+        for line in f:
+            for token in words_by_token.keys() & set(line.split()):
+                for word in words_by_token[token]:
+                    if patterns[word] in line:
+                        hits[word].append(number)
+            number += 1
+            position += len(line)
+            if position >= end:
+                break
+    return number
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
-import os.path
+import os
 import sys
 import lzma
 
 import requests
 
 import config
+import corpus_index
+
+# Size of the compressed chunks we decompress at a time
+chunk_size = 65536
 
 
 def fetch():
@@ -20,34 +24,68 @@ def fetch():
     txt_filename = filename.replace("xz", "txt")
     if os.path.isfile(txt_filename):
         print(f"Data for {config.language} has already been downloaded.")
+        # Older downloads have no index yet
+        corpus_index.ensure_index(txt_filename)
     else:
         print(f"Downloading Europarl sentence file for {config.language}")
-        with open(filename, 'wb') as output_file:
-            response = requests.get(url, stream=True)
-            total_length = response.headers.get('content-length')
-            if total_length is None:
-                # no content length header
-                output_file.write(response.content)
-            else:
-                dl = 0
-                total_length = int(total_length)
-                for data in response.iter_content(chunk_size=4096):
-                    dl += len(data)
-                    output_file.write(data)
+        response = requests.get(url, stream=True)
+        if response.status_code != 200:
+            print("Error. Download failed with status code " +
+                  f"{response.status_code}. Report this bug.")
+            return
+        total_length = response.headers.get('content-length')
+        if total_length is not None:
+            total_length = int(total_length)
+        if ingest(response.iter_content(chunk_size=chunk_size),
+                  txt_filename, total_length=total_length):
+            print('\nDownload Completed!!!')
+
+
+def ingest(chunks, txt_filename, total_length=None):
+    """Decompresses the xz chunks while they arrive, writes the corpus and
+    feeds every line to the index builder. Only one chunk and one partial
+    line of the text are held in memory at a time and the index builder
+    keeps at most config.index_buffer_postings postings in memory."""
+    decompressor = lzma.LZMADecompressor()
+    builder = corpus_index.IndexBuilder(txt_filename)
+    # The partial line at the end of the last decompressed chunk
+    rest = b""
+    dl = 0
+    complete = False
+    try:
+        # Write to a temporary file so that an interrupted download is not
+        # mistaken for a complete corpus
+        with open(txt_filename + ".tmp", 'wb') as out:
+            for data in chunks:
+                dl += len(data)
+                decompressed = decompressor.decompress(data)
+                if decompressed:
+                    out.write(decompressed)
+                    lines = (rest + decompressed).split(b"\n")
+                    rest = lines.pop()
+                    for line in lines:
+                        builder.add_line(line + b"\n")
+                if total_length is not None:
                     done = int(50 * dl / total_length)
                     sys.stdout.write(
                         "\r[%s%s]" % ('=' * done, ' ' * (50-done))
                     )
                     sys.stdout.flush()
-
-        print('\nDownload Completed!!!')
-
-        if os.path.isfile(filename):
-            print("Decompressing file")
-            with lzma.open(filename, 'rb') as f:
-                # f is now the uncompressed object
-                # write it to
-                with open(txt_filename, 'wb') as out:
-                    out.write(f.read())
-        else:
-            print("Error. Download failed. Report this bug.")
+        if not decompressor.eof:
+            print("\nError. The download was truncated. Report this bug.")
+            return False
+        complete = True
+    except lzma.LZMAError as e:
+        print(f"\nError. The download is corrupt: {e}. Report this bug.")
+        return False
+    finally:
+        if not complete:
+            # Also when the download itself failed
+            builder.abort()
+            if os.path.isfile(txt_filename + ".tmp"):
+                os.remove(txt_filename + ".tmp")
+    if rest:
+        builder.add_line(rest)
+    os.replace(txt_filename + ".tmp", txt_filename)
+    builder.write()
+    return True
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import config
+import loglevel
+import metrics
+
+# Approved usage examples are stored in a local SQLite queue and uploaded by
+# a background worker so that the review loop never waits for Wikidata.
+# Edits that were not written when the script stopped are picked up again by
+# the next session. Failing edits are retried with exponential backoff and
+# marked as failed after config.edit_max_attempts attempts.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("edit_queue.log")
+logger.addHandler(file_handler)
+
+# Set when an edit is added so that an idle worker wakes up
+wakeup = threading.Event()
+worker = None
+
+
+def connection():
+    db = sqlite3.connect(config.edit_queue_file, timeout=30)
+    db.execute('''
+    CREATE TABLE IF NOT EXISTS edits (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      edit TEXT NOT NULL,
+      status TEXT NOT NULL DEFAULT 'pending',
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt REAL NOT NULL DEFAULT 0,
+      error TEXT
+    )''')
+    return db
+
+
+def enqueue(edit: dict):
+    """Stores the keyword arguments of util.add_usage_example() for the
+    worker"""
+    db = connection()
+    with db:
+        db.execute("INSERT INTO edits (edit) VALUES (?)",
+                   (json.dumps(edit, ensure_ascii=False),))
+    db.close()
+    wakeup.set()
+
+
+def count(status: str):
+    db = connection()
+    result = db.execute(
+        "SELECT COUNT(*) FROM edits WHERE status = ?", (status,)
+    ).fetchone()[0]
+    db.close()
+    return result
+
+
+def next_edit(db):
+    """Returns the id and edit of the oldest pending edit that is due and the
+    number of seconds to wait if none is due"""
+    row = db.execute('''
+    SELECT id, edit, attempts, next_attempt FROM edits
+    WHERE status = 'pending' ORDER BY next_attempt, id LIMIT 1
+    ''').fetchone()
+    if row is None:
+        return None, None
+    edit_id, edit, attempts, next_attempt = row
+    wait = next_attempt - time.time()
+    if wait > 0:
+        return None, wait
+    return (edit_id, json.loads(edit), attempts), 0
+
+
+def process(db, write, failed, edit_id, edit, attempts):
+    """Writes one edit and updates its status"""
+    try:
+        result = write(edit)
+    except Exception as e:
+        attempts += 1
+        if attempts >= config.edit_max_attempts:
+            status = "failed"
+            metrics.increment("edits_failed")
+            print("\nError. Giving up adding the usage example to " +
+                  f"{edit['lid']} after {attempts} attempts: {e}")
+            if failed is not None:
+                failed(edit)
+        else:
+            status = "pending"
+            metrics.increment("edits_retried")
+            logger.warning(f"Attempt {attempts} to edit {edit['lid']} " +
+                           f"failed: {e}")
+        delay = min(config.edit_retry_max_delay,
+                    config.edit_retry_delay * 2 ** (attempts - 1))
+        with db:
+            db.execute('''
+            UPDATE edits SET status = ?, attempts = ?, next_attempt = ?,
+            error = ? WHERE id = ?''', (
+                status, attempts, time.time() + delay, str(e), edit_id
+            ))
+        return
+    if result:
+        status = "done"
+        metrics.increment("edits_done")
+    else:
+        # The edit itself is broken, retrying would not help
+        status = "failed"
+        metrics.increment("edits_failed")
+        print(f"\nError. Could not add the usage example to {edit['lid']}")
+        if failed is not None:
+            failed(edit)
+    with db:
+        db.execute(
+            "UPDATE edits SET status = ?, attempts = ? WHERE id = ?",
+            (status, attempts + 1, edit_id)
+        )
+
+
+def run(write, failed):
+    db = connection()
+    try:
+        while True:
+            item, wait = next_edit(db)
+            if item is None:
+                # Sleep until an edit is added or the next retry is due
+                wakeup.wait(timeout=wait)
+                wakeup.clear()
+                continue
+            process(db, write, failed, *item)
+            # Stay below the rate limit
+            time.sleep(config.edit_min_interval)
+    except BaseException:
+        # Threads die silently otherwise, finish() notices that it stopped
+        logger.exception("The edit queue worker stopped")
+        raise
+
+
+def start(write, failed=None):
+    """Starts the worker which calls write(edit) for every edit. write()
+    returns a true value on success, a false value if the edit can never
+    succeed and raises an exception for errors worth retrying. failed(edit)
+    is called for the edits that are given up."""
+    global worker
+    if worker is not None:
+        return
+    pending = count("pending")
+    if pending > 0:
+        print(f"Resuming upload of {pending} usage examples " +
+              "from the last session")
+    worker = threading.Thread(
+        target=run, args=(write, failed), name="edit_queue", daemon=True
+    )
+    worker.start()
+
+
+def finish():
+    """Waits for the pending edits to be written before the script ends"""
+    pending = count("pending")
+    if pending > 0:
+        print(f"Waiting for {pending} usage examples to be uploaded. " +
+              "Press Ctrl+C to stop, they will be uploaded next time.")
+    try:
+        while count("pending") > 0:
+            if worker is None or not worker.is_alive():
+                print("Error. The upload stopped, see edit_queue.log. " +
+                      "The usage examples will be uploaded next time.")
+                break
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    failed = count("failed")
+    if failed > 0:
+        print(f"{failed} usage examples could not be uploaded, see " +
+              f"the table edits in {config.edit_queue_file}")
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
+import array
 import logging
+import multiprocessing
 
+import candidates
 import config
+import corpus_index
+import corpus_scan
 import loglevel
+import metrics
 
 
 # TODO move common code to common swedish module
@@ -16,44 +22,289 @@ logger.level = logger.getEffectiveLevel()
 file_handler = logging.FileHandler("europarl.log")
 logger.addHandler(file_handler)
 
+# The memory mapped corpus index, see load_index()
+index = None
+# The memory mapped corpus and its line offset table, see load_lines()
+lines = None
+# Bloom filter of the tokens of the corpus, see load_bloom_filter()
+bloom_filter = None
+# Worker processes for scanning without an index, see scan_pool()
+pool = None
+# Line numbers found by prefetch() for a whole batch of forms, keyed by word
+prefetched_records = {}
 
-def find_lines(word):
-    """Returns a dictionary with line as
-    key and linenumber as value"""
-    records = {}
-    print(f"Looking for {word} in the Europarl corpus...")
-    with open(f'data_{config.language_code}.txt', 'r') as searchfile:
+
+def corpus_filename():
+    return f"data_{config.language_code}.txt"
+
+
+def load_index():
+    """Memory maps the inverted index of the corpus. Returns None if there is
+    no index yet, in which case we fall back to scanning the file"""
+    global index
+    if index is None:
+        filename = corpus_filename()
+        if corpus_index.index_exists(filename):
+            index = corpus_index.CorpusIndex(filename)
+        else:
+            logger.info("No index found for the corpus")
+    return index
+
+
+def load_bloom_filter():
+    global bloom_filter
+    if bloom_filter is None:
+        bloom_filter = corpus_index.load_bloom_filter(corpus_filename())
+    return bloom_filter
+
+
+def count_candidates(word):
+    """Returns at most how many lines contain the word without reading the
+    corpus or None if we can't tell. With an index this is the number of
+    lines with its rarest token, otherwise it is 0 if the Bloom filter rules
+    the word out."""
+    tokens = word.split()
+    if len(tokens) == 0:
+        return 0
+    if load_index() is not None:
+        return min(index.count(token) for token in tokens)
+    bloom = load_bloom_filter()
+    if bloom is not None and any(token.encode("utf-8") not in bloom
+                                 for token in tokens):
+        return 0
+    return None
+
+
+def load_lines():
+    """Memory maps the corpus and its line offset and features tables. The
+    tables are part of the index but we build them on their own if the index
+    is missing."""
+    global lines
+    if lines is None:
+        filename = corpus_filename()
+        if not corpus_index.line_tables_exist(filename):
+            corpus_index.build_line_tables(filename)
+        lines = corpus_index.LineTable(filename)
+    return lines
+
+
+def get_line(number):
+    """Returns the text of the line with the number"""
+    return load_lines().line(number)
+
+
+def line_score(number):
+    """Shorter lines are better and lines that don't look like a complete
+    sentence come after the ones that do"""
+    table = load_lines()
+    score = table.characters[number - 1]
+    if table.flags[number - 1] != (corpus_index.starts_capitalized |
+                                   corpus_index.ends_with_punctuation):
+        score += config.sentence_shape_penalty
+    return score
+
+
+def make_record(number):
+    return dict(
+        line=number,
+        document_id=None,
+        date=None,
+        source="europarl",
+        language_style="formal",
+        type_of_reference="written"
+    )
+
+
+def iter_lines(word):
+    """Yields the numbers of the lines containing the word while scanning the
+    corpus, so that the caller can stop the scan early"""
+    pattern = f" {word} ".encode("utf-8")
+    with open(corpus_filename(), 'rb') as searchfile:
         number = 1
         for line in searchfile:
             if number % 50000 == 0:
                 logger.info(number)
-            if f" {word} " in line:
-                logger.debug(f"matching line:{line}")
-                records[line] = dict(
-                    line=number,
-                    document_id=None,
-                    date=None,
-                    source="europarl",
-                    language_style="formal",
-                    type_of_reference="written"
-                )
-            # if line.split(" ")[0] == word:
-            #     print("Found in beginning of line")
-            #     records[line] = number
-            # if line.split(" ")[-1] == word:
-            #     print("Found in end of line")
-            #     records[line] = number
+            if pattern in line:
+                logger.debug(f"matching line:{number}")
+                yield number
             number += 1
-    logger.debug(f"records:{records}")
-    print(f"Found {len(records)} sentences")
-    return records
 
 
+def scan_lines(word):
+    """Returns an array with the numbers of the lines containing the word"""
+    return array.array("I", iter_lines(word))
+
+
+def lookup_lines(word):
+    """Returns the numbers of the lines that may contain the word using the
+    inverted index. The index is token based so the text of the lines has to
+    be checked for ' word ' when they are read, see find_lines()."""
+    return index.lookup(word)
+
+
+def scan_lines_batch(words):
+    """Returns a dictionary with word as key and an array of the numbers of
+    the matching lines as value. The corpus is read once for all the
+    words."""
+    results = {word: array.array("I") for word in words}
+    # Every line matching " word " contains the first token of the word so
+    # we only need to verify the words whose first token is in the line
+    words_by_token = {}
+    for word in words:
+        tokens = word.encode("utf-8").split()
+        if len(tokens) > 0:
+            words_by_token.setdefault(tokens[0], []).append(word)
+    patterns = {word: f" {word} ".encode("utf-8") for word in words}
+    with open(corpus_filename(), 'rb') as searchfile:
+        number = 1
+        for line in searchfile:
+            if number % 50000 == 0:
+                logger.info(number)
+            for token in words_by_token.keys() & set(line.split()):
+                for word in words_by_token[token]:
+                    if patterns[word] in line:
+                        results[word].append(number)
+            number += 1
+    return results
+
+
+def scan_pool():
+    global pool
+    if pool is None:
+        # Forking a process with running threads is not safe
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(config.scan_processes)
+    return pool
+
+
+def scan_lines_parallel(words):
+    """Returns a dictionary with word as key and an array of the numbers of
+    the matching lines as value. The corpus is split in one range of lines
+    per process and the ranges are scanned in parallel."""
+    filename = corpus_filename()
+    ranges = corpus_scan.line_boundaries(filename, config.scan_processes)
+    chunks = scan_pool().starmap(
+        corpus_scan.scan_chunk,
+        [(filename, start, end, list(words)) for start, end in ranges]
+    )
+    results = {word: array.array("I") for word in words}
+    # The line numbers of a range start at 0 so we add the number of lines
+    # in the ranges before it
+    lines_before = 0
+    for line_count, hits in chunks:
+        for word in hits:
+            results[word].extend(
+                lines_before + number + 1 for number in hits[word]
+            )
+        lines_before += line_count
+    return results
+
+
+def find_lines_batch(words):
+    """Returns a dictionary with word as key and the numbers of the matching
+    lines as value"""
+    words = set(words)
+    print(f"Looking for {len(words)} forms in the Europarl corpus...")
+    if load_index() is not None:
+        results = {word: lookup_lines(word) for word in words}
+    else:
+        # Don't scan for the words that are certainly not in the corpus
+        missing = {word for word in words if count_candidates(word) == 0}
+        if len(words - missing) == 0:
+            results = {}
+        elif config.scan_processes > 1:
+            results = scan_lines_parallel(words - missing)
+        else:
+            results = scan_lines_batch(words - missing)
+        for word in missing:
+            results[word] = array.array("I")
+    print("Found sentences for " +
+          f"{sum(1 for word in results if len(results[word]) > 0)} forms")
+    return results
+
+
+def prefetch(words):
+    """Searches for all the words in one pass over the corpus and keeps the
+    line numbers for find_lines() until the next batch. With an index every
+    lookup is already cheap so we don't hold them in memory in that case."""
+    if load_index() is not None:
+        logger.info("Index present, no need to prefetch")
+        return
+    # Drop the line numbers of the previous batch
+    prefetched_records.clear()
+    prefetched_records.update(find_lines_batch(words))
+
+
+def find_lines(word, score=None):
+    """Returns the numbers of up to config.max_candidates lines containing
+    the word with the lowest score first. Lines with too few or too many words
+    are left out. The score of a line number defaults to line_score(). Use
+    get_line() to read them."""
+    if score is None:
+        score = line_score
+    accept = None
+    table = load_lines()
+    if word in prefetched_records:
+        # Forms of different lexemes can share the same spelling so we keep
+        # the line numbers until the next batch
+        numbers = prefetched_records[word]
+        logger.info(f"Found {len(numbers)} sentences for {word} " +
+                    "in the prefetched batch")
+    else:
+        logger.info(f"Looking for {word} in the Europarl corpus...")
+        if load_index() is not None:
+            numbers = lookup_lines(word)
+            # The index hits are only candidates so we read the lines that
+            # would be selected
+            pattern = f" {word} "
+
+            def accept(number):
+                return pattern in get_line(number)
+        elif count_candidates(word) == 0:
+            logger.info(f"{word} is not in the Bloom filter of the corpus")
+            numbers = array.array("I")
+        elif config.scan_processes > 1:
+            numbers = scan_lines_parallel([word])[word]
+        else:
+            numbers = None
+    if numbers is not None:
+        numbers = table.filter(
+            numbers, config.min_word_count, config.max_word_count
+        )
+    else:
+        # The scan stops when enough short lines were found
+        words = table.words
+        numbers = (
+            number for number in iter_lines(word)
+            if config.min_word_count <= words[number - 1]
+            <= config.max_word_count
+        )
+    selected = candidates.select(
+        numbers, config.max_candidates, score, accept=accept,
+        good_enough=config.short_sentence_length,
+    )
+    logger.info(f"Selected {len(selected)} sentences")
+    return array.array("I", selected)
+
+
+def get_candidates(data):
+    """Returns the best lines as (score, sentence, result data) candidates,
+    see sources.py"""
+    return [
+        (line_score(number), get_line(number).strip(), make_record(number))
+        for number in get_records(data)
+    ]
+
+
+@metrics.timed("europarl.get_records")
 def get_records(data):
+    """Returns the numbers of the matching lines. The lines are already split
+    in sentences in the corpus so they are presented as is, see get_line()
+    and make_record()."""
     word = data["word"]
-    # The lines are already split in sentences in the corpus. so we just return
-    # them as is
-    return find_lines(word)
+    numbers = find_lines(word)
+    metrics.increment("europarl_records", len(numbers))
+    return numbers
 
     # TODO check len of records
     # if records is not None:
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import asyncio
+import atexit
+import logging
+import threading
+
+import config
+import http_client
+import loglevel
+
+# One long lived asyncio event loop running in a background thread for the
+# whole session. The synchronous code submits coroutines to it with submit()
+# and gets concurrent.futures.Future objects back, so async work of
+# different forms overlaps and shares the async HTTP clients of the loop.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("event_loop.log")
+logger.addHandler(file_handler)
+
+lock = threading.Lock()
+loop = None
+thread = None
+
+
+def get_loop():
+    """Returns the running background loop and starts it if needed"""
+    global loop, thread
+    with lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="event-loop", daemon=True
+            )
+            thread.start()
+            logger.info("Started the background event loop")
+        return loop
+
+
+def submit(coroutine):
+    """Schedules the coroutine on the background loop and returns a
+    concurrent.futures.Future with its result"""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop())
+
+
+def stop():
+    """Closes the async clients and stops the loop"""
+    global loop, thread
+    with lock:
+        if loop is None:
+            return
+        running_loop, loop = loop, None
+        running_thread, thread = thread, None
+    try:
+        asyncio.run_coroutine_threadsafe(
+            http_client.aclose(), running_loop
+        ).result(timeout=5)
+    except Exception as e:
+        logger.warning(f"Could not close the async clients: {e}")
+    running_loop.call_soon_threadsafe(running_loop.stop)
+    running_thread.join(timeout=5)
+    if not running_thread.is_alive():
+        running_loop.close()
+    logger.info("Stopped the background event loop")
+
+
+atexit.register(stop)
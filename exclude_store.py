@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+from datetime import datetime, timedelta
+import json
+import logging
+import os.path
+import threading
+
+import config
+import loglevel
+
+# The exclude list holds the forms we already worked on so that we don't
+# present them again before the SPARQL endpoint has caught up with our edits.
+# It is loaded once per session into a dictionary for O(1) lookups and
+# persisted in an append-only log of JSON lines, one line per excluded form.
+# The log is compacted when it holds many expired or superseded lines.
+# Entries of forms that got a usage example are marked with example=True.
+# Forms are removed again by a line with removed=True.
+# The SPARQL query leaves out every lexeme with a usage example so the other
+# forms of such a lexeme are excluded as well.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("exclude_store.log")
+logger.addHandler(file_handler)
+
+# form_id -> form_data, None until load() has been called
+entries = None
+# lid -> form_data of the latest usage example added to the lexeme
+examples = {}
+lock = threading.Lock()
+
+
+def expired(form_data: dict):
+    if config.exclude_list_ttl_days is None:
+        return False
+    date = datetime.fromisoformat(form_data["date"])
+    return datetime.now() - date > timedelta(
+        days=config.exclude_list_ttl_days
+    )
+
+
+def load():
+    """Reads the legacy JSON file and the log into memory"""
+    global entries
+    entries = {}
+    examples.clear()
+    log_lines = 0
+    # The exclude list used to be one JSON object rewritten on every save
+    if os.path.isfile(config.exclude_list):
+        with open(config.exclude_list, 'r', encoding='utf-8') as myfile:
+            json_data = myfile.read()
+        if len(json_data) > 0:
+            entries.update(json.loads(json_data))
+    if os.path.isfile(config.exclude_log):
+        with open(config.exclude_log, 'r', encoding='utf-8') as myfile:
+            for line in myfile:
+                log_lines += 1
+                try:
+                    form_data = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # The last line might be cut off by a crash
+                    logger.warning(f"Skipping bad line in exclude log:{line}")
+                    continue
+                form_id = form_data.pop("form_id")
+                if form_data.get("removed"):
+                    entries.pop(form_id, None)
+                else:
+                    entries[form_id] = form_data
+    for form_id in [
+            form_id for form_id in entries if expired(entries[form_id])
+    ]:
+        del entries[form_id]
+    for form_data in entries.values():
+        index_example(form_data)
+    logger.info(f"Loaded {len(entries)} forms from the exclude list")
+    if log_lines > 2 * len(entries) + 1000:
+        compact()
+
+
+def compact():
+    """Rewrites the log with only the live entries"""
+    with open(config.exclude_log + ".tmp", 'w', encoding='utf-8') as outfile:
+        for form_id in entries:
+            write_entry(outfile, form_id, entries[form_id])
+    os.replace(config.exclude_log + ".tmp", config.exclude_log)
+    logger.info(f"Compacted the exclude log to {len(entries)} lines")
+
+
+def write_entry(outfile, form_id: str, form_data: dict):
+    outfile.write(json.dumps(
+        dict(form_id=form_id, **form_data), ensure_ascii=False
+    ) + "\n")
+
+
+def index_example(form_data: dict):
+    if form_data.get("example") and "lid" in form_data:
+        examples[form_data["lid"]] = form_data
+
+
+def add(form_id: str, form_data: dict):
+    with lock:
+        if entries is None:
+            load()
+        entries[form_id] = form_data
+        index_example(form_data)
+        with open(config.exclude_log, 'a', encoding='utf-8') as outfile:
+            write_entry(outfile, form_id, form_data)
+
+
+def remove(form_id: str):
+    """Forgets the form so that it is presented again"""
+    with lock:
+        if entries is None:
+            load()
+        form_data = entries.pop(form_id, None)
+        if form_data is None:
+            return
+        if examples.get(form_data.get("lid")) is form_data:
+            del examples[form_data["lid"]]
+        with open(config.exclude_log, 'a', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(dict(form_id=form_id, removed=True)) +
+                          "\n")
+
+
+def contains(form_id: str):
+    with lock:
+        if entries is None:
+            load()
+        form_data = entries.get(form_id)
+    return (
+        form_data is not None
+        and form_data["lang"] == config.language_code
+        and not expired(form_data)
+    )
+
+
+def contains_lexeme(lid: str):
+    """Returns True if a usage example was added to a form of the lexeme"""
+    with lock:
+        if entries is None:
+            load()
+        form_data = examples.get(lid)
+    return (
+        form_data is not None
+        and form_data["lang"] == config.language_code
+        and not expired(form_data)
+    )
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import json
+import logging
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import config
+import loglevel
+import metrics
+
+# A persistent cache of JSON API responses stored in SQLite and keyed by
+# normalized URL. Entries expire after config.http_cache_ttl seconds and the
+# least recently used entries are evicted when the cache grows larger than
+# config.http_cache_max_size_mb.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("http_cache.log")
+logger.addHandler(file_handler)
+
+# SQLite connections cannot be shared between threads
+local = threading.local()
+
+
+def connection():
+    if not hasattr(local, "connection"):
+        local.connection = sqlite3.connect(config.http_cache_file, timeout=30)
+        local.connection.execute('''
+        CREATE TABLE IF NOT EXISTS responses (
+          url TEXT PRIMARY KEY,
+          body TEXT NOT NULL,
+          size INTEGER NOT NULL,
+          fetched REAL NOT NULL,
+          last_used REAL NOT NULL
+        )''')
+        local.connection.execute('''
+        CREATE INDEX IF NOT EXISTS responses_last_used
+        ON responses (last_used)''')
+    return local.connection
+
+
+def normalize_url(url):
+    """Returns the url with lowercase scheme and host and sorted query
+    parameters so that equivalent urls share one cache entry"""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((
+        # http and https give the same answer
+        "https" if parts.scheme.lower() in ("http", "https") else parts.scheme,
+        parts.netloc.lower(),
+        parts.path,
+        query,
+        "",
+    ))
+
+
+def get(url):
+    """Returns the cached JSON data for the url or None"""
+    if not config.http_cache:
+        return None
+    key = normalize_url(url)
+    db = connection()
+    row = db.execute(
+        "SELECT body, fetched FROM responses WHERE url = ?", (key,)
+    ).fetchone()
+    if row is None:
+        metrics.increment("http_cache_misses")
+        logger.debug(f"cache miss:{key}")
+        return None
+    body, fetched = row
+    # Expired entries are still good enough when we are offline
+    if (time.time() - fetched > config.http_cache_ttl
+            and not config.http_cache_only):
+        metrics.increment("http_cache_misses")
+        logger.debug(f"cache expired:{key}")
+        return None
+    with db:
+        db.execute(
+            "UPDATE responses SET last_used = ? WHERE url = ?",
+            (time.time(), key)
+        )
+    metrics.increment("http_cache_hits")
+    logger.debug(f"cache hit:{key}")
+    return json.loads(body)
+
+
+def put(url, data):
+    """Stores the JSON data for the url and evicts old entries if needed"""
+    if not config.http_cache:
+        return
+    key = normalize_url(url)
+    body = json.dumps(data, ensure_ascii=False)
+    now = time.time()
+    db = connection()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+            (key, body, len(body), now, now)
+        )
+    evict()
+
+
+def evict():
+    """Deletes the least recently used entries until the cache fits in
+    config.http_cache_max_size_mb"""
+    max_size = config.http_cache_max_size_mb * 1024 * 1024
+    db = connection()
+    total = db.execute("SELECT TOTAL(size) FROM responses").fetchone()[0]
+    if total <= max_size:
+        return
+    deleted = 0
+    with db:
+        for url, size in db.execute(
+                "SELECT url, size FROM responses ORDER BY last_used"
+        ).fetchall():
+            db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            deleted += 1
+            total -= size
+            if total <= max_size:
+                break
+    logger.info(f"Evicted {deleted} responses from the cache")
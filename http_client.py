@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import asyncio
+import atexit
+import logging
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+
+import config
+import loglevel
+
+# Shared connection pooled HTTP clients. Every request to WDQS and the
+# Riksdagen API goes through these so that the connections are kept alive
+# between forms instead of paying for a new TCP and TLS handshake per call.
+# The MediaWiki calls use the session of WikibaseIntegrator which is pooled
+# already.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("http_client.log")
+logger.addHandler(file_handler)
+
+lock = threading.Lock()
+# The synchronous client, see client()
+sync_client = None
+# Async clients can only be used on the event loop they were created on so
+# we keep one per host per loop. event loop -> host -> httpx.AsyncClient
+async_clients = weakref.WeakKeyDictionary()
+
+
+def client_options():
+    return dict(
+        limits=httpx.Limits(
+            max_connections=config.http_max_connections,
+            max_keepalive_connections=config.http_max_keepalive_connections,
+            keepalive_expiry=config.http_keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            config.http_timeout, connect=config.http_connect_timeout
+        ),
+        # This needs the h2 package
+        http2=config.http2,
+    )
+
+
+def client():
+    """Returns the shared synchronous client. httpx.Client is thread safe."""
+    global sync_client
+    with lock:
+        if sync_client is None:
+            logger.info("Creating the shared HTTP client")
+            sync_client = httpx.Client(**client_options())
+        return sync_client
+
+
+def async_client(url):
+    """Returns the async client for the host of the url on the running event
+    loop"""
+    host = urlsplit(url).netloc.lower()
+    loop = asyncio.get_running_loop()
+    with lock:
+        clients = async_clients.setdefault(loop, {})
+        if host not in clients:
+            logger.info(f"Creating an async HTTP client for {host}")
+            clients[host] = httpx.AsyncClient(**client_options())
+        return clients[host]
+
+
+def get(url, **kwargs):
+    return client().get(url, **kwargs)
+
+
+async def async_get(url, **kwargs):
+    return await async_client(url).get(url, **kwargs)
+
+
+async def aclose():
+    """Closes the async clients of the running event loop"""
+    with lock:
+        clients = async_clients.pop(asyncio.get_running_loop(), {})
+    for host in clients:
+        await clients[host].aclose()
+
+
+def close():
+    global sync_client
+    with lock:
+        if sync_client is not None:
+            sync_client.close()
+            sync_client = None
+
+
+atexit.register(close)
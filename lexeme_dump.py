@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+import bz2
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+import config
+import http_client
+import loglevel
+
+# Offline alternative to the WDQS query in util.fetch_lexeme_forms(). The
+# Wikidata lexemes dump (https://dumps.wikimedia.org/wikidatawiki/entities/
+# latest-lexemes.json.gz) is streamed once and the forms matching the same
+# criteria as the query are written to a small SQLite table. Pages of forms
+# are then read from the table in the format of the SPARQL results.
+#
+# Run this module with the path of a dump to ingest it, or set
+# config.lexeme_source = "dump" and it is ingested on first use.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("lexeme_dump.log")
+logger.addHandler(file_handler)
+
+wd_prefix = "http://www.wikidata.org/entity/"
+# Lexemes that are instances of these are not words, see the WDQS query
+excluded_classes = {
+    "Q62155",  # affix
+    "Q134830",  # prefix
+    "Q102047",  # suffix
+    "Q1153504",  # interfix
+}
+
+
+def open_dump(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt", encoding="utf-8")
+    if filename.endswith(".bz2"):
+        return bz2.open(filename, "rt", encoding="utf-8")
+    return open(filename, encoding="utf-8")
+
+
+def iter_lexemes(filename):
+    """Yields the lexemes of a dump. The dump is a JSON array with one entity
+    per line so we never have to parse all of it at once."""
+    with open_dump(filename) as dump:
+        for line in dump:
+            line = line.strip().rstrip(",")
+            if line in ("[", "]", ""):
+                continue
+            yield json.loads(line)
+
+
+def truthy(statements):
+    """Returns the statements that WDQS exposes as wdt: triples"""
+    statements = [statement for statement in statements
+                  if statement.get("rank") != "deprecated"]
+    if any(statement.get("rank") == "preferred" for statement in statements):
+        statements = [statement for statement in statements
+                      if statement.get("rank") == "preferred"]
+    return [statement for statement in statements
+            if statement["mainsnak"]["snaktype"] != "novalue"]
+
+
+def item_values(statements):
+    return {
+        statement["mainsnak"]["datavalue"]["value"]["id"]
+        for statement in truthy(statements)
+        if statement["mainsnak"]["snaktype"] == "value"
+    }
+
+
+def eligible_forms(lexeme):
+    """Returns a list of (form id, word) of the lexeme that the WDQS query
+    would return"""
+    if lexeme.get("language") != config.language_qid:
+        return []
+    claims = lexeme.get("claims", {})
+    if len(item_values(claims.get("P31", [])) & excluded_classes) > 0:
+        return []
+    # Lexemes with a usage example are left out
+    if len(truthy(claims.get("P5831", []))) > 0:
+        return []
+    # At least one sense has to be linked to an item
+    if not any(len(truthy(sense.get("claims", {}).get("P5137", []))) > 0
+               for sense in lexeme.get("senses", [])):
+        return []
+    forms = []
+    for form in lexeme.get("forms", []):
+        if len(form.get("grammaticalFeatures", [])) == 0:
+            continue
+        words = {representation["value"] for representation
+                 in form.get("representations", {}).values()}
+        for word in sorted(words):
+            forms.append((form["id"], word))
+    return forms
+
+
+def fetch_category_labels(qids):
+    """Returns a dictionary with the English labels of the lexical categories
+    from WDQS. This is a single small query per ingest. Without a connection
+    the QIDs are used as labels."""
+    labels = {qid: qid for qid in qids}
+    if len(qids) == 0:
+        return labels
+    values = " ".join(f"wd:{qid}" for qid in sorted(qids))
+    query = f'''
+    SELECT ?cat ?catLabel WHERE {{
+      VALUES ?cat {{ {values} }}
+      SERVICE wikibase:label
+      {{ bd:serviceParam wikibase:language "en". }}
+    }}'''
+    try:
+        r = http_client.get(config.wdqs_endpoint,
+                            params={'format': 'json', 'query': query})
+        for binding in r.json()["results"]["bindings"]:
+            labels[binding["cat"]["value"].replace(wd_prefix, "")] = (
+                binding["catLabel"]["value"]
+            )
+    except Exception as e:
+        logger.warning(f"Could not fetch the category labels: {e}")
+    return labels
+
+
+def ingest(dump_filename, db_filename=None):
+    """Streams the dump and writes the eligible forms to the table"""
+    if db_filename is None:
+        db_filename = config.lexeme_db_file
+    print(f"Reading the {config.language} lexemes in {dump_filename}. " +
+          "This is only done once.")
+    # Build in a temporary file so that an interrupted ingest is never
+    # mistaken for a complete table
+    if os.path.isfile(db_filename + ".tmp"):
+        os.remove(db_filename + ".tmp")
+    db = sqlite3.connect(db_filename + ".tmp")
+    db.execute('''
+    CREATE TABLE forms (
+      form_id TEXT NOT NULL,
+      lid TEXT NOT NULL,
+      word TEXT NOT NULL,
+      category TEXT NOT NULL,
+      PRIMARY KEY (form_id, word)
+    )''')
+    db.execute('''
+    CREATE TABLE categories (
+      qid TEXT PRIMARY KEY,
+      label TEXT NOT NULL
+    )''')
+    count_lexemes = 0
+    count_forms = 0
+    categories = set()
+    rows = []
+    for lexeme in iter_lexemes(dump_filename):
+        count_lexemes += 1
+        if count_lexemes % 100000 == 0:
+            logger.info(f"Read {count_lexemes} lexemes")
+        forms = eligible_forms(lexeme)
+        if len(forms) == 0:
+            continue
+        categories.add(lexeme["lexicalCategory"])
+        for form_id, word in forms:
+            rows.append((form_id, lexeme["id"], word,
+                         lexeme["lexicalCategory"]))
+        if len(rows) >= 10000:
+            db.executemany("INSERT OR IGNORE INTO forms VALUES (?, ?, ?, ?)",
+                           rows)
+            count_forms += len(rows)
+            rows = []
+    db.executemany("INSERT OR IGNORE INTO forms VALUES (?, ?, ?, ?)", rows)
+    count_forms += len(rows)
+    labels = fetch_category_labels(categories)
+    db.executemany("INSERT INTO categories VALUES (?, ?)", labels.items())
+    db.commit()
+    db.close()
+    os.replace(db_filename + ".tmp", db_filename)
+    print(f"Found {count_forms} forms in {count_lexemes} lexemes")
+
+
+def ensure_ingested():
+    if not os.path.isfile(config.lexeme_db_file):
+        ingest(config.lexeme_dump_file)
+
+
+def fetch_forms(after=None):
+    """Returns one page of forms like util.fetch_lexeme_forms(), starting
+    after the (form, word) key. The page is empty when there are no more."""
+    ensure_ingested()
+    if after is None:
+        after = ("", "")
+    db = sqlite3.connect(config.lexeme_db_file)
+    try:
+        rows = db.execute('''
+        SELECT forms.lid, forms.form_id, forms.word,
+               COALESCE(categories.label, forms.category)
+        FROM forms LEFT JOIN categories ON categories.qid = forms.category
+        WHERE forms.form_id > ? OR (forms.form_id = ? AND forms.word > ?)
+        ORDER BY forms.form_id, forms.word
+        LIMIT ?''', (
+            after[0].replace(wd_prefix, ""), after[0].replace(wd_prefix, ""),
+            after[1], config.sparql_results_size,
+        )).fetchall()
+    finally:
+        db.close()
+    return [dict(
+        l=dict(value=wd_prefix + lid),
+        form=dict(value=wd_prefix + form_id),
+        word=dict(value=word),
+        catLabel=dict(value=label),
+    ) for lid, form_id, word, label in rows]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} latest-lexemes.json.gz")
+        exit(1)
+    ingest(sys.argv[1])
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import sys
 
 import config
 
@@ -12,7 +13,10 @@ def set_loglevel():
         "--log",
         help="Loglevel",
     )
-    args = parser.parse_args()
+    # Scripts like riksdagen_mirror.py take arguments of their own, leave
+    # those in sys.argv for them
+    args, rest = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + rest
     loglevel = args.log
     if loglevel:
         numeric_level = getattr(logging, loglevel.upper(), None)
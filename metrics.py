@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import asyncio
+import atexit
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import config
+import loglevel
+
+# Timing of the stages of a session and counters of what happened in them.
+# Wrap a stage with the timed() decorator and count events with increment().
+# A JSON summary is written to config.metrics_file when the script exits and
+# a Prometheus textfile to config.metrics_prometheus_file if it is set.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("metrics.log")
+logger.addHandler(file_handler)
+
+# Upper bounds in seconds of the latency histogram buckets
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+lock = threading.Lock()
+# stage -> dictionary with count, sum, min, max and bucket counts
+histograms = {}
+# name -> int
+counters = {}
+started = time.time()
+
+
+def observe(stage: str, seconds: float):
+    with lock:
+        if stage not in histograms:
+            histograms[stage] = dict(
+                count=0, sum=0.0, min=seconds, max=seconds,
+                buckets=[0] * len(buckets),
+            )
+        histogram = histograms[stage]
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["min"] = min(histogram["min"], seconds)
+        histogram["max"] = max(histogram["max"], seconds)
+        for number, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram["buckets"][number] += 1
+                break
+
+
+def increment(name: str, amount: int = 1):
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def timed(stage: str):
+    """Decorator that records the latency of every call of the function and
+    counts the calls that raised an exception. Cancelled coroutines are
+    counted on their own."""
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                except asyncio.CancelledError:
+                    # Lookups are cancelled routinely once we have enough
+                    # sentences, that is not an error
+                    increment(f"{stage}_cancelled")
+                    raise
+                except BaseException:
+                    increment(f"{stage}_errors")
+                    raise
+                finally:
+                    observe(stage, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except BaseException:
+                increment(f"{stage}_errors")
+                raise
+            finally:
+                observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def summary():
+    with lock:
+        stages = {}
+        for stage in histograms:
+            histogram = histograms[stage]
+            stages[stage] = dict(
+                count=histogram["count"],
+                sum=round(histogram["sum"], 6),
+                mean=round(histogram["sum"] / histogram["count"], 6),
+                min=round(histogram["min"], 6),
+                max=round(histogram["max"], 6),
+                # Not cumulative, the last bucket holds the slower calls
+                buckets={
+                    **{str(bound): count for bound, count in zip(
+                        buckets, histogram["buckets"]
+                    )},
+                    "+Inf": histogram["count"] - sum(histogram["buckets"]),
+                },
+            )
+        return dict(
+            started=started,
+            seconds=round(time.time() - started, 3),
+            stages=stages,
+            counters=dict(counters),
+        )
+
+
+def prometheus():
+    """Returns the metrics in the Prometheus text exposition format"""
+    data = summary()
+    lines = [
+        "# HELP lexuse_stage_seconds Latency of the stages of LexUse",
+        "# TYPE lexuse_stage_seconds histogram",
+    ]
+    for stage in data["stages"]:
+        stage_data = data["stages"][stage]
+        cumulative = 0
+        for bound in stage_data["buckets"]:
+            cumulative += stage_data["buckets"][bound]
+            lines.append(f'lexuse_stage_seconds_bucket{{stage="{stage}",' +
+                         f'le="{bound}"}} {cumulative}')
+        lines.append(f'lexuse_stage_seconds_sum{{stage="{stage}"}} ' +
+                     f'{stage_data["sum"]}')
+        lines.append(f'lexuse_stage_seconds_count{{stage="{stage}"}} ' +
+                     f'{stage_data["count"]}')
+    for name in data["counters"]:
+        # Counters like the errors of a stage contain dots, which are not
+        # allowed in metric names
+        metric = "lexuse_" + re.sub("[^a-zA-Z0-9_]", "_", name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {data['counters'][name]}")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomically(filename, content):
+    with open(filename + ".tmp", "w", encoding="utf-8") as outfile:
+        outfile.write(content)
+    os.replace(filename + ".tmp", filename)
+
+
+def export():
+    if config.metrics_file is not None:
+        write_atomically(config.metrics_file,
+                         json.dumps(summary(), indent=2))
+        logger.info(f"Wrote metrics to {config.metrics_file}")
+    if config.metrics_prometheus_file is not None:
+        write_atomically(config.metrics_prometheus_file, prometheus())
+        logger.info("Wrote Prometheus metrics to " +
+                    f"{config.metrics_prometheus_file}")
+
+
+atexit.register(export)
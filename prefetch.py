@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import config
+import loglevel
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("prefetch.log")
+logger.addHandler(file_handler)
+
+
+class Pipeline:
+    """Runs prepare(item) in worker threads for the next items while the
+    consumer works on the current one.
+
+    Iterating yields (item, prepared) tuples in the order of the items. At
+    most config.prefetch_depth items are prepared ahead of the consumer.
+    Items for which skip(item) is true are dropped before any work is done
+    for them. Exceptions raised by prepare() are raised again when the
+    consumer reaches the item. done(item) is called for the items that are
+    skipped and for every item the consumer finished, which is when it asks
+    for the next one."""
+    def __init__(self, items, prepare, skip=None, done=None):
+        self.items = iter(items)
+        self.prepare = prepare
+        self.skip = skip
+        self.done = done
+        self.pending = deque()
+
+    def fill(self, executor):
+        while len(self.pending) < config.prefetch_depth:
+            item = next(self.items, None)
+            if item is None:
+                return
+            if self.skip is not None and self.skip(item):
+                if self.done is not None:
+                    self.done(item)
+                continue
+            self.pending.append((item, executor.submit(self.prepare, item)))
+            logger.debug(f"Queued {len(self.pending)} items for prefetching")
+
+    def __iter__(self):
+        with ThreadPoolExecutor(
+                max_workers=config.prefetch_workers,
+                thread_name_prefix="prefetch",
+        ) as executor:
+            try:
+                self.fill(executor)
+                while len(self.pending) > 0:
+                    item, future = self.pending.popleft()
+                    self.fill(executor)
+                    yield item, future.result()
+                    if self.done is not None:
+                        self.done(item)
+            finally:
+                # Don't start work for items nobody will look at
+                for item, future in self.pending:
+                    future.cancel()
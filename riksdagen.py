@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
-import re
-import httpx
+import math
 
 import config
+import http_cache
+import http_client
 import loglevel
-import util
+import metrics
+import riksdagen_mirror
+import sentences
 
 logger = logging.getLogger(__name__)
 if config.loglevel is None:
@@ -21,63 +24,77 @@ logger.addHandler(file_handler)
 baseurl = "https://data.riksdagen.se/dokument/"
 
 
-def get_result_count(word):
-    # First find out the number of results
-    url = (f"http://data.riksdagen.se/dokumentlista/?sok={word}" +
-           "&sort=rel&sortorder=desc&utformat=json&a=s&p=1")
-    r = httpx.get(url)
-    data = r.json()
-    results = int(data["dokumentlista"]["@traffar"])
-    logging.info(f"results:{results}")
-    return results
+def page_url(word, page):
+    return (config.riksdagen_api_url + f"?sok={word}" +
+            f"&sort=rel&sortorder=desc&utformat=json&a=s&p={page}")
+
+
+def empty_page():
+    """This is what the API returns when there are no hits"""
+    return {"dokumentlista": {"@traffar": "0"}}
+
+
+def records_from_page(data):
+    """Returns the list of documents in a dokumentlista page"""
+    # check if dokument is in the list
+    if "dokument" in data["dokumentlista"]:
+        return data["dokumentlista"]["dokument"]
+    return []
 
 
 async def async_fetch(word):
-    # This function is called for every task.
+    """Yields the dokumentlista pages for the word as they arrive. At most
+    config.riksdagen_max_concurrent_requests pages are in flight at a time
+    and no more pages are requested when the consumer stops iterating."""
     async def get(url, session):
-        """Accepts a url and a httpx session"""
+        """Accepts a url and a shared httpx async client"""
+        # The cache is SQLite, keep its blocking calls off the event loop
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, http_cache.get, url)
+        if data is not None:
+            return data
+        if config.http_cache_only:
+            logger.info(f"Not in cache and offline:{url}")
+            return empty_page()
         response = await session.get(url)
-        return response
+        data = response.json()
+        if response.status_code == 200:
+            await loop.run_in_executor(None, http_cache.put, url, data)
+        return data
 
-    # Get total results count
-    results = get_result_count(word)
-    # Generate the urls
+    session = http_client.async_client(config.riksdagen_api_url)
+    # The first page also tells us the total number of results
+    first_page = await get(page_url(word, 1), session)
+    yield first_page
+    results = int(first_page["dokumentlista"]["@traffar"])
+    logging.info(f"results:{results}")
     if results > config.riksdagen_max_results_size:
         results = config.riksdagen_max_results_size
-    # generate urls
-    urls = []
     # divide by 20 to know how many requests to send
-    for i in range(1, int(results / 20)):
-        urls.append(f"http://data.riksdagen.se/dokumentlista/?sok={word}" +
-                    f"&sort=rel&sortorder=desc&utformat=json&a=s&p={i}")
-    logging.debug(f"urls:{urls}")
-    # get urls asynchroniously
-    # inspired by https://trio.readthedocs.io/en/stable/tutorial.html
-    async with httpx.AsyncClient() as session:
-        logger.info("Gathering tasks.")
-        # inspired by https://stackoverflow.com/questions/56161595/
-        # how-to-use-async-for-in-python
-        results = await asyncio.gather(*[get(url, session) for url in urls])
-        logger.info(f"All {len(results)} tasks done")
-        return results
-
-
-def process_async_responses(word):
-    print("Downloading from the Riksdagen API...")
-    results = asyncio.run(async_fetch(word))
-    records = []
-    for response in results:
-        data = response.json()
-        # check if dokument is in the list
-        key_list = list(data["dokumentlista"].keys())
-        if "dokument" in key_list:
-            for item in data["dokumentlista"]["dokument"]:
-                records.append(item)
-    print("Download done")
-    logger.info(f"Got {len(records)} records from the Riksdagen API")
-    if config.debug_json:
-        logger.debug(f"records:{records}")
-    return records
+    pages = iter(range(2, math.ceil(results / 20) + 1))
+    max_pending = config.riksdagen_max_concurrent_requests
+    pending = set()
+    try:
+        while True:
+            # Keep the number of requests in flight bounded
+            for page in pages:
+                url = page_url(word, page)
+                logging.debug(f"url:{url}")
+                pending.add(asyncio.ensure_future(get(url, session)))
+                if len(pending) >= max_pending:
+                    break
+            if len(pending) == 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        # The consumer found enough sentences, cancel the rest
+        for task in pending:
+            task.cancel()
+        logger.info(f"Cancelled {len(pending)} pending requests")
 
 
 # def fetch(word):
@@ -119,89 +136,9 @@ def find_usage_examples_from_summary(
         word_spaces=None,
         summary=None
 ):
-    """This tries to find and clean sentences and return the shortest one"""
-    # TODO check for duplicates or near duplicates and remove
-    cleaned_summary = summary.replace(
-        '<span class="traff-markering">', ""
-    )
-    cleaned_summary = cleaned_summary.replace('</span>', "")
-    ellipsis = "…"
-    # replace "t.ex." temporarily to avoid regex problems
-    cleaned_summary = cleaned_summary.replace("t.ex.", "xxx")
-    # Leave the last dot of m.m. to retain the full stop it probably
-    # means
-    cleaned_summary = cleaned_summary.replace("m.m", "yyy")
-    cleaned_summary = cleaned_summary.replace("dvs.", "qqq")
-    # bl.a.
-    cleaned_summary = cleaned_summary.replace("bl.", "zzz")
-    # TODO add "ang." "kl." "s.k." "resp." "prop." "skr."
-
-    # from https://stackoverflow.com/questions/3549075/
-    # regex-to-find-all-sentences-of-text
-    sentences = re.findall(
-        "[A-Z].*?[\.!?]", cleaned_summary, re.MULTILINE | re.DOTALL
-    )
-    # Remove duplicates naively using sets
-    sentences_without_duplicates = list(set(sentences))
-    if config.debug_duplicates:
-        print("Sentences after duplicate removal " +
-              f"{sentences_without_duplicates}")
-    suitable_sentences = []
-    for sentence in sentences_without_duplicates:
-        exclude_this_sentence = False
-        # Exclude based on lenght of the sentence
-        word_count = util.count_words(sentence)
-        if (
-                word_count > config.max_word_count or word_count <
-                config.min_word_count
-        ):
-            exclude_this_sentence = True
-            # Exclude by breaking out of the iteration early
-            break
-        else:
-            # Exclude based on weird words
-            excluded_words = [
-                "SAMMANFATTNING",
-                "BETÄNKANDE",
-                "UTSKOTT",
-                "MOTION",
-                " EG ",
-                " EU ",
-                "RIKSDAGEN",
-            ]
-            for excluded_word in excluded_words:
-                result = sentence.upper().find(excluded_word)
-                if result != -1:
-                    if config.debug_excludes:
-                        sentence = (sentence
-                                    .replace("\n", "")
-                                    .replace("-", "")
-                                    .replace(ellipsis, ""))
-                        logging.debug(
-                            f"Found excluded word {excluded_word} " +
-                            f"in {sentence}. Skipping",
-                        )
-                    exclude_this_sentence = True
-                    break
-        # Add space to match better
-        if word_spaces in sentence and exclude_this_sentence is False:
-            # restore the t.ex.
-            sentence = sentence.replace("xxx", "t.ex.")
-            sentence = sentence.replace("yyy", "m.m")
-            sentence = sentence.replace("qqq", "dvs.")
-            sentence = sentence.replace("zzz", "bl.")
-            # Last cleaning
-            sentence = (sentence
-                        .replace("\n", "")
-                        # This removes "- " because the data is hyphenated
-                        # sometimes
-                        .replace("- ", "")
-                        .replace(ellipsis, "")
-                        .replace("  ", " "))
-            if config.debug_sentences:
-                logging.debug(f"suitable_sentence:{sentence}")
-            suitable_sentences.append(sentence)
-    return suitable_sentences
+    """This tries to find and clean sentences and return the suitable
+    ones"""
+    return sentences.get_extractor().extract(summary, word_spaces)
 
 
 def extract_summaries_from_records(records, data):
@@ -230,7 +167,7 @@ def extract_summaries_from_records(records, data):
         # quality it seems.
         date = record["datum"]
         if config.debug_summaries:
-            print(
+            logger.info(
                 f"Found in https://data.riksdagen.se/dokument/{document_id}"
             )
         record_data = {}
@@ -254,45 +191,87 @@ def extract_summaries_from_records(records, data):
                     logging.info("No exact hit in summary. Skipping.")
         else:
             if config.debug_summaries and added is False:
-                print(f"'{word}' not found as part of a word or a " +
-                      "word in the summary. Skipping")
+                logger.info(f"'{word}' not found as part of a word or a " +
+                            "word in the summary. Skipping")
         count_summary += 1
     # if config.debug_summaries:
     #     logging.debug(f"summaries:{summaries}")
-    print(f"Processed {count_summary} records and found " +
-          f"{count_exact_hits} exact hits for the form '{word}'")
+    logger.info(f"Processed {count_summary} records and found " +
+                f"{count_exact_hits} exact hits for the form '{word}'")
     logging.info(f"among {count_inexact_hits} where the lexeme was present.")
     return summaries
 
 
-def get_records(data):
-    word = data["word"]
-    records = process_async_responses(word)
-    if records is not None:
-        if config.debug:
-            print("Looping through records from Riksdagen")
-        summaries = extract_summaries_from_records(records, data)
-        unsorted_sentences = {}
-        # Iterate through the dictionary
-        for summary in summaries:
-            # Get result_data
-            result_data = summaries[summary]
-            # Add information about the source (written,oral) and
-            # (formal,informal)
-            result_data["language_style"] = "formal"
-            result_data["type_of_reference"] = "written"
-            result_data["line"] = None
-            result_data["source"] = "riksdagen"
-            # document_id = result_data["document_id"]
-            # if config.debug_summaries:
-            #     print(f"Got back summary {summary} with the " +
-            #           f"correct document_id: {document_id}?")
-            suitable_sentences = find_usage_examples_from_summary(
-                word_spaces=data["word_spaces"],
-                summary=summary
-            )
-            if len(suitable_sentences) > 0:
-                for sentence in suitable_sentences:
-                    # Make sure the riksdagen_document_id follows
-                    unsorted_sentences[sentence] = result_data
-        return unsorted_sentences
+def sentences_from_records(records, data):
+    """Returns a dictionary with suitable sentences as key and result data
+    as value"""
+    if config.debug:
+        print("Looping through records from Riksdagen")
+    summaries = extract_summaries_from_records(records, data)
+    unsorted_sentences = {}
+    # Clean the whole page with the compiled rules
+    suitable_sentences = sentences.get_extractor().extract_all(
+        summaries, data["word_spaces"]
+    )
+    # Iterate through the dictionary
+    for summary in suitable_sentences:
+        # Get result_data
+        result_data = summaries[summary]
+        # Add information about the source (written,oral) and
+        # (formal,informal)
+        result_data["language_style"] = "formal"
+        result_data["type_of_reference"] = "written"
+        result_data["line"] = None
+        result_data["source"] = "riksdagen"
+        for sentence in suitable_sentences[summary]:
+            # Make sure the riksdagen_document_id follows
+            unsorted_sentences[sentence] = result_data
+    return unsorted_sentences
+
+
+@metrics.timed("riksdagen.get_records")
+async def async_get_records(data):
+    """Cleans every page as soon as it arrives and stops fetching when we
+    have found config.riksdagen_enough_sentences suitable sentences"""
+    if config.riksdagen_backend == "local":
+        # Ranking all the matches of a common word takes a while, keep the
+        # SQLite query off the event loop so the other lookups go on
+        loop = asyncio.get_running_loop()
+        records = await loop.run_in_executor(
+            None, riksdagen_mirror.search, data["word"]
+        )
+        metrics.increment("riksdagen_records", len(records))
+        return sentences_from_records(records, data)
+    unsorted_sentences = {}
+    count_pages = 0
+    count_records = 0
+    pages = async_fetch(data["word"])
+    try:
+        async for page in pages:
+            count_pages += 1
+            records = records_from_page(page)
+            count_records += len(records)
+            if config.debug_json:
+                logger.debug(f"records:{records}")
+            unsorted_sentences.update(sentences_from_records(records, data))
+            if len(unsorted_sentences) >= config.riksdagen_enough_sentences:
+                logger.info("Found enough sentences, stopping early")
+                break
+    finally:
+        await pages.aclose()
+    logger.info(f"Got {count_records} records in {count_pages} pages " +
+                "from the Riksdagen API")
+    metrics.increment("riksdagen_pages", count_pages)
+    metrics.increment("riksdagen_records", count_records)
+    return unsorted_sentences
+
+
+async def async_get_candidates(data):
+    """Returns the suitable sentences as (score, sentence, result data)
+    candidates, see sources.py"""
+    unsorted_sentences = await async_get_records(data)
+    return [
+        (len(sentence), sentence, unsorted_sentences[sentence])
+        for sentence in unsorted_sentences
+    ]
+
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import html
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import zipfile
+
+import config
+import loglevel
+
+# A local full text mirror of Riksdagen documents. The bulk open data
+# archives from https://data.riksdagen.se/data/dokument/ (zip files with one
+# JSON file per document) are imported into an SQLite FTS5 index and
+# searched instead of the API when config.riksdagen_backend is "local".
+# search() returns records shaped like the dokument entries of the API so
+# that riksdagen.sentences_from_records() handles both.
+#
+# Run this module with the paths of the archives to import them.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("riksdagen_mirror.log")
+logger.addHandler(file_handler)
+
+# The same markers as the API so the sentence extraction can remove them
+hit_start = '<span class="traff-markering">'
+hit_end = '</span>'
+# Number of tokens in the text returned around a hit
+snippet_tokens = 64
+tags = re.compile("<[^>]+>")
+
+# SQLite connections cannot be shared between threads
+local = threading.local()
+
+
+def connection():
+    if not hasattr(local, "connection"):
+        local.connection = sqlite3.connect(config.riksdagen_mirror_file,
+                                           timeout=30)
+        local.connection.execute('''
+        CREATE TABLE IF NOT EXISTS documents (
+          id INTEGER PRIMARY KEY,
+          dok_id TEXT UNIQUE NOT NULL,
+          datum TEXT
+        )''')
+        # Keep å, ä and ö apart from a and o so "har" does not match "hår"
+        local.connection.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(
+          text,
+          tokenize = "unicode61 remove_diacritics 0"
+        )''')
+    return local.connection
+
+
+def document_from_json(data):
+    """Returns (dok_id, datum, text) of a document in the format of the bulk
+    archives or None"""
+    if "dokumentstatus" in data:
+        data = data["dokumentstatus"]
+    document = data.get("dokument", data)
+    if not isinstance(document, dict) or "dok_id" not in document:
+        return None
+    text = document.get("text")
+    if not text:
+        text = html.unescape(tags.sub(" ", document.get("html") or ""))
+    if not text.strip():
+        return None
+    datum = document.get("datum")
+    if datum:
+        # The archives have a time as well
+        datum = datum[:10]
+    return document["dok_id"], datum, text
+
+
+def iter_documents(filename):
+    """Yields the documents of a zip archive or a single JSON file"""
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            for name in archive.namelist():
+                if not name.endswith(".json"):
+                    continue
+                with archive.open(name) as member:
+                    data = json.loads(member.read().decode("utf-8-sig"))
+                document = document_from_json(data)
+                if document is not None:
+                    yield document
+    else:
+        with open(filename, encoding="utf-8-sig") as infile:
+            document = document_from_json(json.load(infile))
+        if document is not None:
+            yield document
+
+
+def import_archives(filenames):
+    db = connection()
+    count_new = 0
+    count_documents = 0
+    for filename in filenames:
+        print(f"Importing {filename}")
+        with db:
+            for dok_id, datum, text in iter_documents(filename):
+                count_documents += 1
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO documents (dok_id, datum) " +
+                    "VALUES (?, ?)", (dok_id, datum)
+                )
+                if cursor.rowcount == 0:
+                    # Already imported from an earlier archive
+                    continue
+                db.execute("INSERT INTO texts (rowid, text) VALUES (?, ?)",
+                           (cursor.lastrowid, text))
+                count_new += 1
+    print(f"Imported {count_new} new documents of {count_documents}")
+
+
+def phrase_query(word):
+    # Quote the word so that FTS5 treats it as a phrase and not as syntax
+    return '"' + word.replace('"', '""') + '"'
+
+
+def search(word, limit=None):
+    """Returns up to limit records with id, datum and summary of the best
+    matching documents"""
+    if limit is None:
+        limit = config.riksdagen_max_results_size
+    if not os.path.isfile(config.riksdagen_mirror_file):
+        logger.warning("There is no local Riksdagen mirror, import " +
+                       "archives with riksdagen_mirror.py first")
+        return []
+    rows = connection().execute(f'''
+    SELECT documents.dok_id, documents.datum,
+           snippet(texts, 0, ?, ?, '…', {snippet_tokens})
+    FROM texts JOIN documents ON documents.id = texts.rowid
+    WHERE texts MATCH ?
+    ORDER BY rank
+    LIMIT ?''', (hit_start, hit_end, phrase_query(word), limit)).fetchall()
+    return [dict(id=dok_id, datum=datum, summary=summary)
+            for dok_id, datum, summary in rows]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} archive.zip [archive.zip ...]")
+        exit(1)
+    import_archives(sys.argv[1:])
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import logging
+import re
+
+import config
+import loglevel
+import metrics
+
+# Extraction of usage example candidates from free text like the summaries
+# returned by the Riksdagen API. All the rules of a language are compiled
+# into a few regular expressions once so that cleaning a summary is a
+# handful of passes over it no matter how many rules there are.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("sentences.log")
+logger.addHandler(file_handler)
+
+# Rules per language code
+rules = {
+    "sv": dict(
+        # Abbreviations that contain dots which don't end a sentence.
+        # Leave the last dot of m.m. to retain the full stop it probably
+        # means
+        # TODO add "ang." "kl." "s.k." "resp." "prop." "skr."
+        abbreviations=["t.ex.", "m.m", "dvs.", "bl."],
+        # Sentences containing these (case insensitive) are not suitable
+        excluded_words=[
+            "SAMMANFATTNING",
+            "BETÄNKANDE",
+            "UTSKOTT",
+            "MOTION",
+            " EG ",
+            " EU ",
+            "RIKSDAGEN",
+        ],
+    ),
+}
+default_rules = dict(abbreviations=[], excluded_words=[])
+
+
+class SentenceExtractor:
+    """Finds and cleans the sentences in a text that are suitable as usage
+    examples"""
+    def __init__(self, language_code):
+        language_rules = rules.get(language_code, default_rules)
+        # The API marks the hits with spans
+        self.markup = re.compile(
+            '<span class="traff-markering">|</span>'
+        )
+        # A sentence starts with a capital letter and ends with the first
+        # dot, exclamation or question mark that is not part of an
+        # abbreviation. The lookahead keeps the regex from backtracking
+        # into the middle of an abbreviation.
+        # inspired by https://stackoverflow.com/questions/3549075/
+        # regex-to-find-all-sentences-of-text
+        if len(language_rules["abbreviations"]) > 0:
+            abbreviations = "|".join(
+                re.escape(abbreviation)
+                for abbreviation in language_rules["abbreviations"]
+            )
+            self.sentence = re.compile(
+                f"[A-Z](?:{abbreviations}|(?!{abbreviations})[^.!?])*[.!?]"
+            )
+        else:
+            self.sentence = re.compile("[A-Z][^.!?]*[.!?]")
+        if len(language_rules["excluded_words"]) > 0:
+            self.excluded = re.compile(
+                "|".join(
+                    re.escape(word)
+                    for word in language_rules["excluded_words"]
+                ),
+                re.IGNORECASE
+            )
+        else:
+            self.excluded = None
+        # This removes "- " because the data is hyphenated sometimes, also
+        # when the hyphen is followed by a line break
+        self.cleanup = re.compile("-\n* |\n|…")
+
+    def extract(self, summary, word_spaces):
+        """Returns the list of suitable sentences containing word_spaces"""
+        # TODO check for near duplicates and remove
+        text = self.markup.sub("", summary)
+        suitable_sentences = []
+        # Counted per call to keep the locking out of the loop
+        rejected = dict(word_count=0, excluded_word=0, missing_word=0)
+        # Remove duplicates but keep the order
+        for sentence in dict.fromkeys(self.sentence.findall(text)):
+            # Exclude based on lenght of the sentence, counted like
+            # util.count_words()
+            word_count = len(sentence.strip().split(" "))
+            if (
+                    word_count > config.max_word_count or word_count <
+                    config.min_word_count
+            ):
+                rejected["word_count"] += 1
+                continue
+            # Exclude based on weird words
+            if self.excluded is not None:
+                match = self.excluded.search(sentence)
+                if match is not None:
+                    if config.debug_excludes:
+                        logging.debug(
+                            f"Found excluded word {match.group()} " +
+                            f"in {sentence}. Skipping",
+                        )
+                    rejected["excluded_word"] += 1
+                    continue
+            # Add space to match better
+            if word_spaces in sentence:
+                # Last cleaning
+                sentence = self.cleanup.sub("", sentence).replace("  ", " ")
+                if config.debug_sentences:
+                    logging.debug(f"suitable_sentence:{sentence}")
+                suitable_sentences.append(sentence)
+            else:
+                rejected["missing_word"] += 1
+        metrics.increment("sentences_kept", len(suitable_sentences))
+        for rule in rejected:
+            if rejected[rule] > 0:
+                metrics.increment(f"sentences_rejected_{rule}",
+                                  rejected[rule])
+        return suitable_sentences
+
+    def extract_all(self, summaries, word_spaces):
+        """Returns a dictionary with summary as key and the list of suitable
+        sentences as value for every summary with at least one"""
+        results = {}
+        for summary in summaries:
+            suitable_sentences = self.extract(summary, word_spaces)
+            if len(suitable_sentences) > 0:
+                results[summary] = suitable_sentences
+        return results
+
+
+# Compiled extractors per language code, see get_extractor()
+extractors = {}
+
+
+def get_extractor(language_code=None):
+    if language_code is None:
+        language_code = config.language_code
+    if language_code not in extractors:
+        extractors[language_code] = SentenceExtractor(language_code)
+    return extractors[language_code]
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import asyncio
+import heapq
+import logging
+import time
+
+import config
+import europarl
+import event_loop
+import loglevel
+import metrics
+import riksdagen
+
+# The sources of usage examples. Every source is a function taking the data
+# of a form and returning a list of (score, sentence, result data)
+# candidates where a lower score is better. Coroutine functions run on the
+# shared event loop and plain functions in a thread pool. All the sources of
+# a form are queried at the same time.
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("sources.log")
+logger.addHandler(file_handler)
+
+# Sources per language code
+sources = {
+    "sv": [
+        dict(name="europarl", find=europarl.get_candidates),
+        dict(name="riksdagen", find=riksdagen.async_get_candidates),
+    ],
+}
+executor = ThreadPoolExecutor(
+    max_workers=config.source_workers, thread_name_prefix="source"
+)
+
+
+def deadline(source):
+    return config.source_deadlines.get(
+        source["name"], config.default_source_deadline
+    )
+
+
+class Lookup:
+    """The candidates of one form from all the sources, best first.
+
+    Creating a lookup starts every source and waits until one of them found
+    candidates or each of them finished or passed its deadline, unless wait
+    is False and the caller calls wait_for_deadlines() itself. Sources that
+    finish later are merged in by pop() so the slowest source does not hold
+    up the first sentence.
+    Forms spelled the same share a lookup and rewind() it in between."""
+    def __init__(self, data, language_code=None, wait=True):
+        if language_code is None:
+            language_code = config.language_code
+        self.heap = []
+        # Candidates handed out by pop() since the last rewind()
+        self.popped = []
+        # Number of candidates merged so far
+        self.found = 0
+        # future -> source
+        self.pending = {}
+        self.started = time.monotonic()
+        for source in sources.get(language_code, []):
+            self.start(source, data)
+        if wait:
+            self.wait_for_deadlines()
+
+    def start(self, source, data):
+        if asyncio.iscoroutinefunction(source["find"]):
+            future = event_loop.submit(source["find"](data))
+        else:
+            future = executor.submit(source["find"], data)
+
+        def record_latency(future):
+            metrics.observe(f"source.{source['name']}",
+                            time.monotonic() - self.started)
+        future.add_done_callback(record_latency)
+        self.pending[future] = source
+
+    def wait_for_deadlines(self):
+        while len(self.heap) == 0:
+            now = time.monotonic()
+            waiting = [
+                future for future in self.pending
+                if self.started + deadline(self.pending[future]) > now
+            ]
+            if len(waiting) == 0:
+                break
+            timeout = min(
+                self.started + deadline(self.pending[future])
+                for future in waiting
+            ) - now
+            wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+            self.merge()
+        now = time.monotonic()
+        for future in self.pending:
+            if self.started + deadline(self.pending[future]) > now:
+                # Still within its deadline but we have sentences to show
+                continue
+            name = self.pending[future]["name"]
+            logger.info(f"{name} missed its deadline, merging it later")
+            metrics.increment(f"source_{name}_late")
+
+    def merge(self):
+        """Adds the candidates of the sources that finished"""
+        for future in [future for future in self.pending if future.done()]:
+            source = self.pending.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                candidates = future.result()
+            except Exception as e:
+                # One broken source should not stop the others
+                logger.warning(f"{source['name']} failed: {e}")
+                metrics.increment(f"source_{source['name']}_errors")
+                continue
+            for score, sentence, result_data in candidates:
+                # The count keeps equal scores in arrival order
+                heapq.heappush(
+                    self.heap, (score, self.found, sentence, result_data)
+                )
+                self.found += 1
+        if self.found >= config.max_candidates and len(self.pending) > 0:
+            # Like the serial lookup did we don't wait for slow sources when
+            # the others already found plenty
+            logger.info(f"Cancelling {len(self.pending)} sources, " +
+                        f"found {self.found} candidates")
+            self.cancel()
+
+    def cancel(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+
+    def pop(self):
+        """Returns the best (sentence, result data) or None when every
+        source is done. Waits for the late sources if nothing else is
+        left."""
+        self.merge()
+        while len(self.heap) == 0 and len(self.pending) > 0:
+            names = [self.pending[future]["name"] for future in self.pending]
+            print(f"Waiting for {', '.join(names)}...")
+            wait(list(self.pending), return_when=FIRST_COMPLETED)
+            self.merge()
+        if len(self.heap) == 0:
+            return None
+        candidate = heapq.heappop(self.heap)
+        self.popped.append(candidate)
+        score, count, sentence, result_data = candidate
+        return sentence, result_data
+
+    def rewind(self):
+        """Makes the candidates that were popped available again"""
+        for candidate in self.popped:
+            heapq.heappush(self.heap, candidate)
+        self.popped = []
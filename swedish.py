@@ -26,8 +26,7 @@ def main():
     begin = util.introduction()
     if begin:
         print("Fetching lexeme forms to work on")
-        results = util.fetch_lexeme_forms()
-        util.process_lexeme_data(results)
+        util.process_lexeme_data()
 
 
 if __name__ == "__main__":
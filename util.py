@@ -2,19 +2,26 @@
 from datetime import datetime, timezone
 import json
 import logging
-import os.path
-import random
 import sys
+import threading
 import time
 # import asyncio
-import httpx
 from wikibaseintegrator import wbi_core, wbi_login
+from wikibaseintegrator.wbi_config import config as wbi_config
 
 import config
 import download_data
+import edit_queue
 import europarl
+import exclude_store
+import http_client
+import lexeme_dump
 import loglevel
+import metrics
+import prefetch
 import riksdagen
+import sources
+import work_queue
 
 # Terminology used
 # record = sentence + data
@@ -42,20 +49,30 @@ logger.level = logger.getEffectiveLevel()
 file_handler = logging.FileHandler("util.log")
 logger.addHandler(file_handler)
 
+# Let WBI back off when the Wikidata servers are lagging
+wbi_config["MAXLAG"] = config.maxlag
+wbi_config["MEDIAWIKI_API_URL"] = config.mediawiki_api_url
+wbi_config["SPARQL_ENDPOINT_URL"] = config.wdqs_endpoint
+
 # Constants
 wd_prefix = "http://www.wikidata.org/entity/"
 
+# Senses prefetched for the lexemes that are not done yet,
+# lid -> (time fetched, senses)
+sense_cache = {}
+sense_cache_lock = threading.Lock()
+
 #
 # Program flow
 #
 # Entry through process_lexeme_data()
-# Call in while loop
-#   if not excluded:
+# Call in while loop over the lexemes
+#   Call get_sentences_for_lexeme() once per spelling
+#     sources.Lookup queries the sources at the same time
+#       europarl.get_candidates(data)
+#       riksdagen.async_get_candidates(data)
+#   if form not excluded:
 #     process_result()
-#       Call get_sentences_from_apis()
-#         Call europarl..get_records(data)
-#         Call riksdagen.get_records(data)
-#         Collect records in one big dictionary
 #       for loop
 #         present_sentence()
 #           Sort showing shortest first
@@ -97,14 +114,19 @@ def yes_no_question(message: str):
                 return answer[0].lower() == 'y'
 
 
-def sparql_query(query):
+def sparql_select(query):
+    """Returns the list of bindings, which might be empty"""
     # from https://stackoverflow.com/questions/55961615/
     # how-to-integrate-wikidata-query-in-python
-    url = 'https://query.wikidata.org/sparql'
-    r = httpx.get(url, params={'format': 'json', 'query': query})
+    url = config.wdqs_endpoint
+    r = http_client.get(url, params={'format': 'json', 'query': query})
     data = r.json()
     # pprint(data)
-    results = data["results"]["bindings"]
+    return data["results"]["bindings"]
+
+
+def sparql_query(query):
+    results = sparql_select(query)
     # pprint(results)
     if len(results) == 0:
         print(f"No {config.language} lexemes containing " +
@@ -132,37 +154,102 @@ def count_number_of_senses_with_P5137(lid):
     return count
 
 
-def fetch_senses(lid):
-    """Returns dictionary with numbers as keys and a dictionary as value with
-    sense id and gloss"""
+@metrics.timed("fetch_senses_batch")
+def fetch_senses_batch(lids):
+    """Returns a dictionary with lid as key and a dictionary as value with
+    numbers as keys and a dictionary with sense id and gloss as value.
+    Lexemes without senses get an empty dictionary."""
     # Thanks to Lucas Werkmeister https://www.wikidata.org/wiki/Q57387675 for
     # helping with this query.
-    result = (sparql_query(f'''
-    SELECT
-    ?sense ?gloss
-    WHERE {{
-      VALUES ?l {{wd:{lid}}}.
-      ?l ontolex:sense ?sense.
-      ?sense skos:definition ?gloss.
-      # Get only the swedish gloss, exclude otherwise
-      FILTER(LANG(?gloss) = "{config.language_code}")
-      # Exclude lexemes without a linked QID from at least one sense
-      ?sense wdt:P5137 [].
-    }}'''))
-    senses = {}
-    number = 1
-    for row in result:
-        senses[number] = {
-            "sense_id": row["sense"]["value"].replace(wd_prefix, ""),
-            "gloss": row["gloss"]["value"]
-        }
-        number += 1
-    logging.debug(f"senses:{senses}")
+    lids = list(lids)
+    all_senses = {lid: {} for lid in lids}
+    for start in range(0, len(lids), config.sense_batch_size):
+        values = " ".join(
+            f"wd:{lid}" for lid in lids[start:start + config.sense_batch_size]
+        )
+        result = sparql_select(f'''
+        SELECT
+        ?l ?sense ?gloss
+        WHERE {{
+          VALUES ?l {{{values}}}.
+          ?l ontolex:sense ?sense.
+          ?sense skos:definition ?gloss.
+          # Get only the swedish gloss, exclude otherwise
+          FILTER(LANG(?gloss) = "{config.language_code}")
+          # Exclude lexemes without a linked QID from at least one sense
+          ?sense wdt:P5137 [].
+        }}''')
+        for row in result:
+            senses = all_senses[row["l"]["value"].replace(wd_prefix, "")]
+            senses[len(senses) + 1] = {
+                "sense_id": row["sense"]["value"].replace(wd_prefix, ""),
+                "gloss": row["gloss"]["value"]
+            }
+    logging.debug(f"fetched senses for {len(all_senses)} lexemes")
+    return all_senses
+
+
+def refresh_senses(lids):
+    """Fetches the senses and stores them in the sense cache"""
+    try:
+        all_senses = fetch_senses_batch(lids)
+    except Exception as e:
+        # This runs in the background, get_senses() fetches the senses of
+        # lexemes that are not in the cache itself
+        logger.warning(f"Could not prefetch senses: {e}")
+        return
+    fetched = time.time()
+    with sense_cache_lock:
+        for lid in all_senses:
+            sense_cache[lid] = (fetched, all_senses[lid])
+
+
+def prefetch_senses(lids):
+    """Fills the sense cache for all the lexemes in the background"""
+    thread = threading.Thread(
+        target=refresh_senses, args=(set(lids),), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def get_senses(lid):
+    """Returns the senses of the lexeme from the sense cache if possible.
+    Stale entries are returned as is and refreshed in the background."""
+    with sense_cache_lock:
+        cached = sense_cache.get(lid)
+    if cached is not None:
+        metrics.increment("sense_cache_hits")
+        fetched, senses = cached
+        if time.time() - fetched > config.sense_cache_max_age:
+            prefetch_senses([lid])
+        return senses
+    metrics.increment("sense_cache_misses")
+    senses = fetch_senses_batch([lid])[lid]
+    with sense_cache_lock:
+        sense_cache[lid] = (time.time(), senses)
     return senses
 
 
-def fetch_lexeme_forms():
-    return sparql_query(f'''
+@metrics.timed("fetch_lexeme_forms")
+def fetch_lexeme_forms(after=None):
+    """Returns one page of forms ordered by form and word, starting after the
+    (form, word) key or at the beginning. The page is empty when there are
+    no more."""
+    if config.lexeme_source == "dump":
+        results = lexeme_dump.fetch_forms(after)
+        metrics.increment("forms_fetched", len(results))
+        return results
+    if after is None:
+        keyset = ""
+    else:
+        # Keyset pagination, unlike an offset this stays fast deep into
+        # the results and does not skip or repeat forms when they change
+        form = json.dumps(after[0], ensure_ascii=False)
+        word = json.dumps(after[1], ensure_ascii=False)
+        keyset = (f"FILTER(STR(?form) > {form} || " +
+                  f"(STR(?form) = {form} && STR(?word) > {word}))")
+    results = sparql_select(f'''
     SELECT DISTINCT
     ?l ?form ?word ?catLabel
     WHERE {{
@@ -190,12 +277,15 @@ def fetch_lexeme_forms():
       ?form wikibase:grammaticalFeature [].
       # We extract the word of the form
       ?form ontolex:representation ?word.
+      {keyset}
       SERVICE wikibase:label
       {{ bd:serviceParam wikibase:language "en". }}
     }}
+    ORDER BY STR(?form) STR(?word)
     limit {config.sparql_results_size}
-    offset {config.sparql_offset}
     ''')
+    metrics.increment("forms_fetched", len(results))
+    return results
 
 
 def extract_data(result):
@@ -220,11 +310,10 @@ def extract_data(result):
 
 
 async def async_fetch_from_url(url):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        return response
+    return await http_client.async_get(url)
 
 
+@metrics.timed("add_usage_example")
 def add_usage_example(
         document_id=None,
         sentence=None,
@@ -257,7 +346,8 @@ def add_usage_example(
         else:
             print(f"Error. Language style {language_style} " +
                   "not one of (formal,informal)")
-            exit(1)
+            # This runs in the edit queue worker, retrying would not help
+            return False
     logging.debug("Generating qualifier language_style " +
                   f"with {style}")
     language_style_qualifier = wbi_core.ItemID(
@@ -274,7 +364,7 @@ def add_usage_example(
         else:
             print(f"Error. Type of reference {type_of_reference} " +
                   "not one of (written,oral)")
-            exit(1)
+            return False
     logging.debug("Generating qualifier type of reference " +
                   f"with {medium}")
     type_of_reference_qualifier = wbi_core.ItemID(
@@ -394,13 +484,40 @@ def add_usage_example(
         )
     result = item.write(
         config.login_instance,
-        edit_summary="Added usage example with [[Wikidata:LexUse]]"
+        edit_summary="Added usage example with [[Wikidata:LexUse]]",
+        max_retries=config.edit_max_retries_maxlag,
+        retry_after=config.edit_retry_delay,
     )
     if config.debug_json:
         logging.debug(f"result from WBI:{result}")
     return result
 
 
+def write_edit(edit: dict):
+    """Called by the edit queue worker for every approved usage example"""
+    result = add_usage_example(**edit)
+    if result:
+        logger.info("Successfully added usage example " +
+                    f"to {wd_prefix + edit['lid']}")
+        # The query leaves out the lexeme from now on, so we skip its other
+        # forms until it has caught up
+        exclude_store.add(edit["form_id"], exclude_entry(edit, example=True))
+        try:
+            add_to_watchlist(edit["lid"])
+        except Exception as e:
+            # The edit is done, don't let the queue retry it
+            logger.warning(f"Could not add {edit['lid']} to the " +
+                           f"watchlist: {e}")
+    return result
+
+
+def edit_failed(edit: dict):
+    """Called by the edit queue worker for the usage examples it gave up"""
+    # Offer the form again in a later session
+    exclude_store.remove(edit["form_id"])
+    logger.info(f"Removed {edit['form_id']} from the exclude list")
+
+
 def count_words(string):
     # from https://www.pythonpool.com/python-count-words-in-string/
     return(len(string.strip().split(" ")))
@@ -440,13 +557,14 @@ def prompt_choose_sense(senses):
                 return False
 
 
+@metrics.timed("add_to_watchlist")
 def add_to_watchlist(lid):
     # Get session from WBI, it cannot be None because this comes after adding
     # an
     # usage example with WBI.
     session = config.login_instance.get_session()
     # adapted from https://www.mediawiki.org/wiki/API:Watch
-    url = "https://www.wikidata.org/w/api.php"
+    url = config.mediawiki_api_url
     params_token = {
         "action": "query",
         "meta": "tokens",
@@ -472,7 +590,7 @@ def add_to_watchlist(lid):
     )
     if config.debug_json:
         print(result.text)
-    print(f"Added {lid} to your watchlist")
+    logger.info(f"Added {lid} to your watchlist")
 
 
 def prompt_sense_approval(sentence=None, data=None):
@@ -484,7 +602,7 @@ def prompt_sense_approval(sentence=None, data=None):
     # + prompt_multiple_senses()
     lid = data["lid"]
     # This returns a tuple if one sense or a dictionary if multiple senses
-    senses = fetch_senses(lid)
+    senses = get_senses(lid)
     number_of_senses = len(senses)
     logging.debug(f"number_of_senses:{number_of_senses}")
     if number_of_senses > 0:
@@ -538,10 +656,10 @@ def prompt_sense_approval(sentence=None, data=None):
                 return False
     else:
         # Check if any suitable senses exist
-        count = (count_number_of_senses_with_P5137("L35455"))
+        count = (count_number_of_senses_with_P5137(lid))
         if count > 0:
-            print("{language.title()} gloss is missing for {count} sense(s)" +
-                  ". Please fix it manually here: " +
+            print(f"{config.language.title()} gloss is missing for " +
+                  f"{count} sense(s). Please fix it manually here: " +
                   f"{wd_prefix + lid}")
             time.sleep(5)
             return False
@@ -552,29 +670,31 @@ def prompt_sense_approval(sentence=None, data=None):
 
 
 def get_sentences_from_apis(result):
-    """Returns a dict with sentences as key and id as value"""
+    """Returns a sources.Lookup with the candidates of all the sources"""
+    # This runs in the prefetch worker threads so it should not print
     data = extract_data(result)
-    form_id = data["form_id"]
-    word = data["word"]
-    print(f"Trying to find examples for the {data['category']} lexeme " +
-          f"form: {word} with id: {form_id}")
-    if config.language_code == "sv":
-        records = {}
-        # Europarl corpus
-        # Download first
-        download_data.fetch()
-        europarl_records = europarl.get_records(data)
-        for record in europarl_records:
-            records[record] = europarl_records[record]
-        # Riksdagen API is slow, only use it if we must
-        if len(europarl_records) < 50:
-            riksdagen_records = riksdagen.get_records(data)
-            for record in riksdagen_records:
-                records[record] = riksdagen_records[record]
-        logger.debug(f"returning from apis:{records}")
-        return records
-        # TODO K-samsök
-        # TODO Europarl corpus
+    # The Europarl corpus is downloaded by process_lexeme_data(). All the
+    # sources are queried at the same time and the ones that miss their
+    # deadline are merged in while we present the sentences.
+    # TODO K-samsök
+    return sources.Lookup(data)
+
+
+def get_sentences_for_lexeme(results):
+    """Returns a dictionary with the word as key and a sources.Lookup as
+    value for the forms of one lexeme that are not excluded"""
+    # This runs in the prefetch worker threads so it should not print
+    lookups = {}
+    for result in results:
+        data = extract_data(result)
+        # Forms spelled the same share the candidates so every spelling is
+        # searched for once
+        if data["word"] not in lookups and not is_excluded_result(result):
+            lookups[data["word"]] = sources.Lookup(data, wait=False)
+    # The spellings are searched for at the same time
+    for lookup in lookups.values():
+        lookup.wait_for_deadlines()
+    return lookups
 
 
 def present_sentence(
@@ -605,8 +725,8 @@ def present_sentence(
             sense_id = selected_sense["sense_id"]
             sense_gloss = selected_sense["sense_gloss"]
             if (sense_id is not None and sense_gloss is not None):
-                result = False
-                result = add_usage_example(
+                # The edit is uploaded in the background by the edit queue
+                edit_queue.enqueue(dict(
                     document_id=document_id,
                     sentence=sentence,
                     lid=lid,
@@ -618,15 +738,13 @@ def present_sentence(
                     type_of_reference=type_of_reference,
                     source=source,
                     line=line,
-                )
-                if result:
-                    print("Successfully added usage example " +
-                          f"to {wd_prefix + lid}")
-                    add_to_watchlist(lid)
-                    save_to_exclude_list(data)
-                    return True
-                else:
-                    return False
+                ))
+                print("Queued the usage example for upload " +
+                      f"to {wd_prefix + lid}")
+                # The lexeme is excluded as well once the edit is written,
+                # see write_edit()
+                save_to_exclude_list(data)
+                return True
             else:
                 return False
     elif result is None:
@@ -636,6 +754,18 @@ def present_sentence(
         return False
 
 
+def exclude_entry(data: dict, example: bool = False):
+    """Returns the entry of the form in the exclude list, data can be the
+    data of a form or an edit"""
+    return dict(
+        word=data["word"],
+        lid=data["lid"],
+        date=datetime.now().isoformat(),
+        lang=config.language_code,
+        example=example,
+    )
+
+
 def save_to_exclude_list(data: dict):
     # date, lid and lang
     if data is None:
@@ -643,101 +773,92 @@ def save_to_exclude_list(data: dict):
         exit(1)
     form_id = data["form_id"]
     word = data["word"]
-    print(f"Adding {word} to local exclude list '{config.exclude_list}'")
+    print(f"Adding {word} to local exclude list '{config.exclude_log}'")
     if config.debug_exclude_list:
         logging.debug(f"data to exclude:{data}")
-    form_data = dict(
-        word=word,
-        date=datetime.now().isoformat(),
-        lang=config.language_code,
-    )
+    form_data = exclude_entry(data)
     if config.debug_exclude_list:
         logging.debug(f"adding:{form_id}:{form_data}")
-    if os.path.isfile('exclude_list.json'):
-        # Read the file
-        with open(config.exclude_list, 'r', encoding='utf-8') as myfile:
-            json_data = myfile.read()
-        if len(json_data) > 0:
-            with open(config.exclude_list, 'w', encoding='utf-8') as myfile:
-                # parse file
-                exclude_list = json.loads(json_data)
-                exclude_list[form_id] = form_data
-                if config.debug_exclude_list:
-                    logging.debug(f"dumping altered list:{exclude_list}")
-                json.dump(exclude_list, myfile, ensure_ascii=False)
-        else:
-            print("Error. json data is null.")
-            exit(1)
-    else:
-        # Create the file
-        with open(config.exclude_list, "w", encoding='utf-8') as outfile:
-            # Create new file with dict and item
-            exclude_list = {}
-            exclude_list[form_id] = form_data
-            if config.debug_exclude_list:
-                logging.debug(f"dumping:{exclude_list}")
-            json.dump(exclude_list, outfile, ensure_ascii=False)
+    exclude_store.add(form_id, form_data)
 
 
-def process_result(result, data):
+def process_result(result, data, sentences_and_result_data=None):
     # ask to continue
     # if yes_no_question(f"\nWork on {data['word']}?"):
-    # This dict holds the sentence as key and
-    # riksdagen_document_id or other id as value
-    sentences_and_result_data = get_sentences_from_apis(result)
+    print(f"Trying to find examples for the {data['category']} lexeme " +
+          f"form: {data['word']} with id: {data['form_id']}")
+    # This holds the sentences with their riksdagen_document_id or other id
     if sentences_and_result_data is not None:
-        # Sort so that the shortest sentence is first
-        sorted_sentences = sorted(
-            sentences_and_result_data, key=len,
-        )
-        count = 1
-        # Loop through sentence list (that has no result data)
-        for sentence in sorted_sentences:
-            # We lookup the sentence in the original dict to get the
-            # result_data
-            result_data = sentences_and_result_data[sentence]
-            document_id = result_data["document_id"]
-            date = result_data["date"]
-            style = result_data["language_style"]
-            medium = result_data["type_of_reference"]
-            source = result_data["source"]
-            line = result_data["line"]
-            if source == "riksdagen":
-                print("Presenting sentence " +
-                      f"{count}/{len(sorted_sentences)} from {date} from " +
-                      f"{riksdagen.baseurl + document_id}")
-            elif source == "europarl":
-                print("Presenting sentence " +
-                      f"{count}/{len(sorted_sentences)} " +
-                      "from europarl")
-            else:
-                print("Presenting sentence " +
-                      f"{count}/{len(sorted_sentences)} from {date}")
-            logging.info(f"with style: {style} " +
-                         f"and medium: {medium}")
-            result = present_sentence(
-                data=data,
-                # Trim sentence
-                sentence=sentence.strip(),
-                document_id=document_id,
-                date=date,
-                language_style=style,
-                type_of_reference=medium,
-                source=source,
-                line=line,
-            )
+        # The lookup might be shared with other forms of the lexeme so the
+        # caller stops it
+        present_candidates(sentences_and_result_data, data)
+        return
+    lookup = get_sentences_from_apis(result)
+    try:
+        present_candidates(lookup, data)
+    finally:
+        # Stop the sources that are still looking
+        lookup.cancel()
+
+
+def present_candidates(lookup, data):
+    print(f"Found {lookup.found} sentences")
+    # The sentences come shortest first. Some are repeated in the corpus.
+    presented = set()
+    count = 1
+    while True:
+        candidate = lookup.pop()
+        if candidate is None:
+            break
+        sentence, result_data = candidate
+        if sentence.strip() in presented:
             count += 1
-            # Break out of the for loop by returning early because one
-            # example was already choosen for this result or if the form
-            # was skipped. False means that we could not find a sentence, it
-            # could be related to low number of records being fetched so we
-            # don't excude it.
-            if result is not False:
-                # Add to temporary exclude_list
+            continue
+        presented.add(sentence.strip())
+        document_id = result_data["document_id"]
+        date = result_data["date"]
+        style = result_data["language_style"]
+        medium = result_data["type_of_reference"]
+        source = result_data["source"]
+        line = result_data["line"]
+        if source == "riksdagen":
+            print("Presenting sentence " +
+                  f"{count}/{lookup.found} from {date} from " +
+                  f"{riksdagen.baseurl + document_id}")
+        elif source == "europarl":
+            print("Presenting sentence " +
+                  f"{count}/{lookup.found} " +
+                  "from europarl")
+        else:
+            print("Presenting sentence " +
+                  f"{count}/{lookup.found} from {date}")
+        logging.info(f"with style: {style} " +
+                     f"and medium: {medium}")
+        result = present_sentence(
+            data=data,
+            # Trim sentence
+            sentence=sentence.strip(),
+            document_id=document_id,
+            date=date,
+            language_style=style,
+            type_of_reference=medium,
+            source=source,
+            line=line,
+        )
+        count += 1
+        # Break out of the loop by returning early because one
+        # example was already choosen for this result or if the form
+        # was skipped. False means that we could not find a sentence, it
+        # could be related to low number of records being fetched so we
+        # don't excude it.
+        if result is not False:
+            if result is None:
+                # Add to temporary exclude_list, present_sentence() already
+                # added the forms that got an example
                 logging.debug("adding to exclude list after presentation")
                 save_to_exclude_list(data)
-                # break
-                return
+            # break
+            return
     # else:
     #     print("Added to excludelist because of no " +
     #           "suitable sentences were found")
@@ -746,69 +867,127 @@ def process_result(result, data):
 
 def in_exclude_list(data: dict):
     # Check if in exclude_list
-    if os.path.isfile('exclude_list.json'):
-        if config.debug_exclude_list:
-            logging.debug("Looking up in exclude list")
-        # Read the file
-        with open('exclude_list.json', 'r', encoding='utf-8') as myfile:
-            json_data = myfile.read()
-            # parse file
-            exclude_list = json.loads(json_data)
-            lid = data["lid"]
-            for form_id in exclude_list:
-                form_data = exclude_list[form_id]
-                if config.debug_exclude_list:
-                    logging.debug(f"found:{form_data}")
-                if (
-                        # TODO check the date also
-                        lid == form_id
-                        and config.language_code == form_data["lang"]
-                ):
-                    logging.debug("Match found")
-                    return True
-        # Not found in exclude_list
-        return False
-    else:
-        # No exclude_list
-        return False
+    if config.debug_exclude_list:
+        logging.debug("Looking up in exclude list")
+    if exclude_store.contains(data["form_id"]):
+        logging.debug("Match found")
+        return True
+    # The query leaves out the lexemes with a usage example
+    if exclude_store.contains_lexeme(data["lid"]):
+        logging.debug("Match found for the lexeme")
+        return True
+    # Not found in exclude_list
+    return False
 
 
-def process_lexeme_data(results):
-    """Go through the SPARQL results randomly"""
+def prepare_batch(results):
+    """Prefetches what we need for a page of SPARQL results"""
     words = []
     for result in results:
         data = extract_data(result)
         words.append(data["word"])
     print(f"Got {len(words)} suitable forms from Wikidata")
     logging.debug(f"words:{words}")
+    # Prepare the senses so that the prompt does not have to wait for them.
+    # The lexemes that will be skipped would never leave the cache.
+    prefetch_senses(extract_data(result)["lid"] for result in results
+                    if not is_excluded_result(result))
+    if config.language_code == "sv":
+        # Search the corpus once for the whole batch instead of once per form
+        europarl.prefetch(words)
+
+
+def forget_senses(results):
+    """Drops the senses of a lexeme that is done from the sense cache"""
+    lid = extract_data(results[0])["lid"]
+    with sense_cache_lock:
+        sense_cache.pop(lid, None)
+
+
+def lacks_corpus_hits(data):
+    """Returns True if the form is certainly not in the corpus and
+    config.skip_forms_without_corpus_hits is set"""
+    if (not config.skip_forms_without_corpus_hits
+            or config.language_code != "sv"):
+        return False
+    return europarl.count_candidates(data["word"]) == 0
+
+
+def lexeme_priority(results):
+    """Returns 1 for lexemes with fewer than config.few_corpus_hits lines in
+    the corpus for every form and 0 for the others"""
+    if config.few_corpus_hits is None or config.language_code != "sv":
+        return 0
+    for result in results:
+        count = europarl.count_candidates(extract_data(result)["word"])
+        # Without an index we only know about the words that are missing
+        if count is None or count >= config.few_corpus_hits:
+            return 0
+    return 1
+
+
+def is_excluded_result(result):
+    data = extract_data(result)
+    if in_exclude_list(data):
+        # Skip if found in the exclude_list
+        logging.debug(
+            f"Skipping result {data['word']} found in exclude_list",
+        )
+        return True
+    if lacks_corpus_hits(data):
+        logging.debug(f"Skipping result {data['word']} not in the corpus")
+        return True
+    return False
+
+
+def is_excluded_lexeme(results):
+    return all(is_excluded_result(result) for result in results)
+
+
+def process_lexeme_data(results=None):
+    """Go through the SPARQL results randomly one lexeme at a time. Without
+    results we resume the saved work queue or fetch the first page."""
+    # Approved usage examples are uploaded in the background
+    edit_queue.start(write_edit, failed=edit_failed)
     # Go through the results at random
     print("Going through the list of forms at random.")
-    # from http://stackoverflow.com/questions/306400/ddg#306417
-    earlier_choices = []
-    while (True):
-        if len(earlier_choices) == config.sparql_results_size:
-            # We have gone checked all results now
-            # TODO offer to fetch more
-            print("No more results. Run the script again to continue")
-            exit(0)
-        else:
-            result = random.choice(results)
-            # Prevent running more than once for each result
-            if result not in earlier_choices:
-                earlier_choices.append(result)
+    if config.language_code == "sv":
+        # Download the corpus and map its index once, it is needed to order
+        # the lexemes of the first page
+        download_data.fetch()
+        europarl.load_index()
+    queue = work_queue.FormQueue(
+        fetch_lexeme_forms, results=results, on_page=prepare_batch,
+        priority=lexeme_priority, on_done=forget_senses,
+    )
+    # Sentences for the next lexemes are gathered in the background while
+    # the user reviews the current one
+    pipeline = prefetch.Pipeline(
+        queue, get_sentences_for_lexeme, skip=is_excluded_lexeme,
+        done=queue.done,
+    )
+    for lexeme_results, lookups in pipeline:
+        try:
+            for result in lexeme_results:
                 data = extract_data(result)
-                word = data['word']
-                logging.debug(f"random choice:{word}")
-                if in_exclude_list(data):
-                    # Skip if found in the exclude_list
-                    logging.debug(
-                        f"Skipping result {word} found in exclude_list",
-                    )
+                # An edit of an earlier form might have excluded this one
+                if in_exclude_list(data) or data["word"] not in lookups:
+                    logging.debug(f"Skipping excluded result {data['word']}")
                     continue
-                else:
-                    # not in exclude_list
-                    logging.debug(f"processing:{word}")
-                    process_result(result, data)
+                logging.debug(f"processing:{data['word']}")
+                lookup = lookups[data["word"]]
+                # An earlier form with the same spelling might have popped
+                # some of the candidates
+                lookup.rewind()
+                process_result(result, data, lookup)
+        finally:
+            # Stop the sources that are still looking
+            for lookup in lookups.values():
+                lookup.cancel()
+    print(f"No {config.language} lexemes containing " +
+          "both a sense, forms with " +
+          "grammatical features and missing a usage example are left")
+    edit_queue.finish()
 
 
 def introduction():
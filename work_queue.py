@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import random
+
+import config
+import loglevel
+
+logger = logging.getLogger(__name__)
+if config.loglevel is None:
+    # Set loglevel
+    loglevel.set_loglevel()
+logger.setLevel(config.loglevel)
+logger.level = logger.getEffectiveLevel()
+file_handler = logging.FileHandler("work_queue.log")
+logger.addHandler(file_handler)
+
+
+def page_key(result):
+    """Returns the (form, word) key that the pages are ordered by"""
+    return (result["form"]["value"], result["word"]["value"])
+
+
+def lexeme_key(result):
+    return result["l"]["value"]
+
+
+def group_by_lexeme(results):
+    """Returns a list with a list of the forms of every lexeme"""
+    groups = {}
+    for result in results:
+        groups.setdefault(lexeme_key(result), []).append(result)
+    return list(groups.values())
+
+
+class FormQueue:
+    """Iterates over the lexemes of the SPARQL results in random order and
+    yields a list of the forms of one lexeme at a time.
+
+    The results are paged through in the order of their (form, word) key
+    with fetch_page(after), the key of the last form of the previous page or
+    None for the first page. The next page is fetched in the background as
+    soon as we start working on a page. Every page is shuffled once by
+    lexeme, keeping the forms of a lexeme next to each other, and saved to
+    config.work_queue_file together with the key of its last form. Pages
+    are ordered by form id so the forms of a lexeme are rarely split
+    between two pages. The position in the page is saved in a small
+    separate file after every lexeme so that the next run resumes where this
+    one stopped and then continues with the following pages instead of
+    starting over. With priority(forms) the shuffled lexemes are sorted by
+    the key it returns for their forms, lowest first, so that the most
+    promising ones come first. An empty page ends the iteration. Consumers
+    call done(forms) when they are done with a lexeme, which calls
+    on_done(forms). The saved position points at the first lexeme handed
+    out that is not done so that it is offered again after a restart, also
+    when the next page was started in the meantime."""
+    def __init__(self, fetch_page, results=None, on_page=None,
+                 priority=None, on_done=None):
+        self.fetch_page = fetch_page
+        self.priority = priority
+        # Called with the forms left in a page when we start working on it
+        self.on_page = on_page
+        # Called with the forms of a lexeme when it is done
+        self.on_done = on_done
+        self.results = []
+        self.after = None
+        self.position = 0
+        # [forms, position] of the lexemes of the page that were handed out
+        # and are not done yet
+        self.open = []
+        # True when the last page was handed out
+        self.exhausted = False
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix="forms")
+        self.next_page = None
+        if results is not None:
+            results = list(results)
+            if len(results) > 0:
+                self.after = max(page_key(result) for result in results)
+            self.start_page(results, self.after)
+            # start_page() prefetched the next page already
+            return
+        if self.load():
+            print(f"Resuming at form {self.position + 1}/" +
+                  f"{len(self.results)} of the saved list of forms")
+            if self.on_page is not None:
+                self.on_page(self.results[self.position:])
+        # Without a saved page this fetches the first one
+        self.prefetch_next_page()
+
+    def prefetch_next_page(self):
+        self.next_page = self.executor.submit(self.fetch_page, self.after)
+
+    def position_filename(self):
+        return config.work_queue_file + ".position"
+
+    def start_page(self, results, after):
+        lexemes = group_by_lexeme(results)
+        random.shuffle(lexemes)
+        if self.priority is not None:
+            # The sort is stable so equal lexemes stay in random order
+            lexemes.sort(key=self.priority)
+        # The lexemes of the previous page that were handed out and are not
+        # done yet stay at the start of the saved page so that they are
+        # offered again after a restart
+        carried = [forms for forms, start in self.open]
+        self.open = []
+        self.results = []
+        for forms in carried:
+            self.open.append([forms, len(self.results)])
+            self.results.extend(forms)
+        self.position = len(self.results)
+        self.results.extend(result for forms in lexemes for result in forms)
+        self.after = after
+        with open(config.work_queue_file + ".tmp", "w",
+                  encoding="utf-8") as outfile:
+            json.dump(dict(after=after, results=self.results), outfile,
+                      ensure_ascii=False)
+        os.replace(config.work_queue_file + ".tmp", config.work_queue_file)
+        self.save_position()
+        logger.info(f"Started page ending at {after} with " +
+                    f"{len(results)} forms")
+        if len(results) > 0:
+            self.prefetch_next_page()
+        else:
+            # An empty page is the last one
+            self.next_page = None
+        if self.on_page is not None and len(results) > 0:
+            self.on_page(self.results[self.position:])
+
+    def load(self):
+        """Returns True if a saved page was loaded"""
+        if not (os.path.isfile(config.work_queue_file)
+                and os.path.isfile(self.position_filename())):
+            return False
+        with open(config.work_queue_file, encoding="utf-8") as infile:
+            state = json.load(infile)
+        if "after" not in state:
+            # Saved by a version that paged with offsets
+            return False
+        with open(self.position_filename()) as infile:
+            self.position = int(infile.read())
+        self.results = state["results"]
+        if state["after"] is not None:
+            self.after = tuple(state["after"])
+        # The following pages continue after this one even when it is done
+        return self.position < len(self.results)
+
+    def save_position(self):
+        with open(self.position_filename(), "w") as outfile:
+            if len(self.open) > 0:
+                outfile.write(str(min(start for forms, start in self.open)))
+            else:
+                outfile.write(str(self.position))
+
+    def done(self, forms):
+        """Marks the lexeme handed out as forms as done"""
+        self.open = [entry for entry in self.open if entry[0] is not forms]
+        if self.exhausted:
+            if len(self.open) == 0:
+                self.clear()
+        else:
+            self.save_position()
+        if self.on_done is not None:
+            self.on_done(forms)
+
+    def clear(self):
+        """Forgets the saved state so that the next run starts over"""
+        for filename in (config.work_queue_file, self.position_filename()):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.position >= len(self.results):
+            page = []
+            if self.next_page is not None:
+                page = self.next_page.result()
+            if len(page) == 0:
+                self.exhausted = True
+                if len(self.open) == 0:
+                    self.clear()
+                self.executor.shutdown(wait=False)
+                raise StopIteration
+            self.start_page(page, max(page_key(result) for result in page))
+        start = self.position
+        end = start + 1
+        while (end < len(self.results) and lexeme_key(self.results[end])
+               == lexeme_key(self.results[start])):
+            end += 1
+        forms = self.results[start:end]
+        # The saved position points at this lexeme until it is done so that
+        # it is offered again if the session ends before it was reviewed
+        self.open.append([forms, start])
+        self.save_position()
+        self.position = end
+        return forms